@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the hot paths of formbuilder: building and rendering forms,
+accepting them, the validators, TAG parsing and the storage files.
+
+    python benchmark.py                       # run all the cases
+    python benchmark.py -k render -k accepts  # the cases matching a pattern
+    python benchmark.py --save before.json    # keep the results
+    python benchmark.py --compare before.json # and compare with them later
+
+For every case it reports the operations per second and the 50th, 90th
+and 99th percentile of the latency of one operation. The memory is not
+measured: python 2 has no way to count the allocations of an operation.
+
+The operations are timed one by one, or in the smallest batches lasting
+--min-time seconds when they are too fast for the timer, for --duration
+seconds and at least --samples times: the slow operations need a longer
+duration for a meaningful 99th percentile.
+
+With --compare the exit status is 1 when a case got slower than the
+threshold, so it can run before an upgrade.
+"""
+
+import os
+import sys
+import time
+import shutil
+import platform
+import tempfile
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import validators
+from storage import Storage, load_storage, save_storage
+from tablebuilder import Table, Field
+from tableform import FORMBUILDER
+from html import TAG
+from uploads import UploadStore
+
+timer = time.time
+if sys.platform == 'win32':
+    timer = time.clock
+
+
+class Case(object):
+    """
+    a benchmark: setup() returns the argument of function, that is the
+    operation measured
+    """
+
+    def __init__(self, name, function, setup=None, teardown=None):
+        self.name = name
+        self.function = function
+        self.setup = setup
+        self.teardown = teardown
+
+
+cases = []
+
+def case(name, setup=None, teardown=None):
+    """ decorator registering a benchmark """
+    def register(function):
+        cases.append(Case(name, function, setup, teardown))
+        return function
+    return register
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def calibrate(function, argument, min_time):
+    """ number of calls taking at least min_time seconds """
+    number = 1
+    while True:
+        t0 = timer()
+        for i in xrange(number):
+            function(argument)
+        if timer() - t0 >= min_time or number >= 1000000:
+            return number
+        number *= 2
+
+
+def measure(case, duration=1.0, min_time=2e-5, min_samples=100,
+            max_samples=100000):
+    """
+    runs the case for duration seconds, and at least min_samples times,
+    timing every call, or batches of calls lasting min_time seconds for
+    the operations faster than that, and returns a dict with the results
+    """
+    argument = case.setup and case.setup() or None
+    try:
+        function = case.function
+        function(argument) # warm up
+        number = calibrate(function, argument, min_time)
+        samples = []
+        end = timer() + duration
+        while len(samples) < max_samples and \
+                (len(samples) < min_samples or timer() < end):
+            t0 = timer()
+            for i in xrange(number):
+                function(argument)
+            samples.append((timer() - t0) / number)
+    finally:
+        if case.teardown:
+            case.teardown(argument)
+    return dict(ops=1.0 / (sum(samples) / len(samples)),
+                p50=percentile(samples, 50),
+                p90=percentile(samples, 90),
+                p99=percentile(samples, 99),
+                number=number, samples=len(samples))
+
+
+# ## the tables
+
+def small_table():
+    return Table(
+        'small',
+        Field('name', 'string', requires=validators.IS_NOT_EMPTY()),
+        Field('age', 'integer', default=20,
+              requires=validators.IS_INT_IN_RANGE(18, 99)),
+        Field('email', 'string', requires=validators.IS_EMAIL()),
+        Field('subscribed', 'boolean', default=False),
+        )
+
+def wide_table(n=50):
+    fields = []
+    for i in range(n):
+        if i % 5 == 0:
+            fields.append(Field('number%s' % i, 'integer',
+                                requires=validators.IS_INT_IN_RANGE(0, 100)))
+        elif i % 5 == 1:
+            fields.append(Field('email%s' % i, 'string',
+                                requires=validators.IS_EMAIL()))
+        elif i % 5 == 2:
+            fields.append(Field('choice%s' % i, 'string',
+                                requires=validators.IS_IN_SET(
+                        ['a', 'b', 'c', 'd'])))
+        elif i % 5 == 3:
+            fields.append(Field('flag%s' % i, 'boolean'))
+        else:
+            fields.append(Field('text%s' % i, 'text',
+                                requires=validators.IS_LENGTH(1000)))
+    return Table('wide', *fields)
+
+def options_table(n=5000):
+    return Table(
+        'options',
+        Field('name', 'string'),
+        Field('country', 'string', requires=validators.IS_IN_SET(
+                [('c%s' % i, 'Country %s' % i) for i in range(n)])),
+        )
+
+def wide_vars(valid=True):
+    vars = {}
+    for field in wide_table():
+        if field.type == 'integer':
+            vars[field.name] = valid and '42' or '420'
+        elif field.name.startswith('email'):
+            vars[field.name] = valid and 'john@example.com' or 'john@'
+        elif field.name.startswith('choice'):
+            vars[field.name] = valid and 'b' or 'z'
+        elif field.type == 'boolean':
+            vars[field.name] = 'on'
+        else:
+            vars[field.name] = 'some text'
+    return vars
+
+
+# ## forms
+
+@case('build small form', small_table)
+def build_small(table):
+    FORMBUILDER(table)
+
+@case('render small form', lambda: FORMBUILDER(small_table()))
+def render_small(form):
+    str(form)
+
+@case('build 50 fields form', wide_table)
+def build_wide(table):
+    FORMBUILDER(table)
+
+@case('render 50 fields form', lambda: FORMBUILDER(wide_table()))
+def render_wide(form):
+    str(form)
+
+@case('build 5000 options form', options_table)
+def build_options(table):
+    FORMBUILDER(table)
+
+@case('render 5000 options form', lambda: FORMBUILDER(options_table()))
+def render_options(form):
+    str(form)
+
+@case('accepts valid 50 fields', lambda: (wide_table(), wide_vars(True)))
+def accepts_valid(args):
+    (table, vars) = args
+    FORMBUILDER(table).accepts(vars)
+
+@case('accepts invalid 50 fields', lambda: (wide_table(), wide_vars(False)))
+def accepts_invalid(args):
+    (table, vars) = args
+    FORMBUILDER(table).accepts(vars)
+
+@case('validate 50 fields', lambda: (wide_table(), wide_vars(True)))
+def validate_wide(args):
+    (table, vars) = args
+    table.validate(vars)
+
+
+# ## validators
+
+def validator_case(name, validator, value):
+    cases.append(Case('validator %s' % name,
+                      lambda argument: validator(value)))
+
+validator_case('IS_NOT_EMPTY', validators.IS_NOT_EMPTY(), 'hello')
+validator_case('IS_INT_IN_RANGE', validators.IS_INT_IN_RANGE(0, 100), '42')
+validator_case('IS_FLOAT_IN_RANGE', validators.IS_FLOAT_IN_RANGE(0, 100),
+               '4.2')
+validator_case('IS_LENGTH', validators.IS_LENGTH(100), 'hello world')
+validator_case('IS_MATCH', validators.IS_MATCH('^\w+$'), 'hello_world')
+validator_case('IS_EXPR', validators.IS_EXPR('int(value) < 100'), '42')
+validator_case('IS_EMAIL', validators.IS_EMAIL(), 'john.smith@example.com')
+validator_case('IS_URL', validators.IS_URL(), 'http://www.example.com/a?b=c')
+validator_case('IS_DATE', validators.IS_DATE(), '2011-05-14')
+validator_case('IS_IN_SET 5000', validators.IS_IN_SET(
+        ['c%s' % i for i in range(5000)]), 'c4999')
+validator_case('IS_LIST_OF', validators.IS_LIST_OF(
+        validators.IS_INT_IN_RANGE(0, 100)), ['1', '2', '3', '4'])
+validator_case('IS_LIST_OF 1000 tags', validators.IS_LIST_OF(
+        validators.IS_LENGTH(20)), ['tag%s' % i for i in range(1000)])
+validator_case('CRYPT', validators.CRYPT(), 'password')
+validator_case('MEMOIZE(IS_URL)', validators.MEMOIZE(validators.IS_URL()),
+               'http://www.example.com/a?b=c')
+validator_case('MEMOIZE(IS_DATE)', validators.MEMOIZE(validators.IS_DATE()),
+               '2011-05-14')
+
+def addresses(n=1000, domains=50):
+    return ['user%s.name@domain%s.example.com' % (i, i % domains)
+            for i in xrange(n)]
+
+@case('IS_EMAIL regex 1000 addresses', addresses)
+def email_regex(values):
+    match = validators.IS_EMAIL.regex.match
+    for value in values:
+        match(value)
+
+@case('IS_EMAIL 1000 addresses', addresses)
+def email_call(values):
+    validator = validators.IS_EMAIL()
+    for value in values:
+        validator(value)
+
+@case('IS_EMAIL validate_many 1000', addresses)
+def email_many(values):
+    validators.IS_EMAIL().validate_many(values)
+
+def column(n=10000):
+    return [str(i % 105) for i in xrange(n)]
+
+@case('IS_INT_IN_RANGE 10000 calls', column)
+def int_calls(values):
+    validator = validators.IS_INT_IN_RANGE(0, 100)
+    for value in values:
+        validator(value)
+
+@case('IS_INT_IN_RANGE validate_column 10000', column)
+def int_column(values):
+    validators.IS_INT_IN_RANGE(0, 100).validate_column(values)
+
+@case('IS_FLOAT_IN_RANGE validate_column 10000', column)
+def float_column(values):
+    validators.IS_FLOAT_IN_RANGE(0, 100).validate_column(values)
+
+
+# ## parsing and storage
+
+@case('TAG parse 50 fields form', lambda: str(FORMBUILDER(wide_table())))
+def parse(html):
+    TAG(html)
+
+def storage_setup():
+    folder = tempfile.mkdtemp()
+    filename = os.path.join(folder, 'settings.storage')
+    settings = Storage(('key%s' % i, Storage(name='setting %s' % i, value=i,
+                        tags=['a', 'b'])) for i in xrange(1000))
+    save_storage(settings, filename)
+    return (folder, filename, settings)
+
+def storage_teardown(args):
+    shutil.rmtree(args[0])
+
+def csv_setup():
+    from cStringIO import StringIO
+    table = small_table()
+    data = 'small.name,small.age,small.email,small.subscribed\n' + ''.join(
+        ['name%s,%s,user%s@example.com,T\n' % (i, i % 100, i)
+         for i in xrange(1000)])
+    return (table, data, StringIO)
+
+@case('import_csv 1000 rows', csv_setup)
+def import_csv(args):
+    (table, data, StringIO) = args
+    for (records, errors) in table.import_csv(StringIO(data), chunksize=250):
+        pass
+
+def upload_setup():
+    from cStringIO import StringIO
+    folder = tempfile.mkdtemp()
+    return (folder, UploadStore(folder, max_size=2 ** 22, dedupe=True),
+            StringIO('x' * 2 ** 20))
+
+@case('UploadStore 1MB upload', upload_setup, storage_teardown)
+def upload_store(args):
+    args[1].save(args[2], 'data.bin')
+
+@case('storage load 1000 keys', storage_setup, storage_teardown)
+def storage_load(args):
+    load_storage(args[1])
+
+@case('storage save 1000 keys', storage_setup, storage_teardown)
+def storage_save(args):
+    save_storage(args[2], args[1])
+
+
+# ## reports
+
+def report(name, result, previous=None):
+    line = '%-38s %12.1f %10.1f %10.1f %10.1f' % (
+        name, result['ops'], result['p50'] * 1e6, result['p90'] * 1e6,
+        result['p99'] * 1e6)
+    if previous:
+        line += ' %+7.1f%%' % (100.0 * (result['ops'] / previous['ops'] - 1))
+    return line
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-k', dest='patterns', action='append', default=[],
+                      help='only run the cases containing PATTERN')
+    parser.add_option('-d', '--duration', type='float', default=1.0,
+                      help='seconds spent timing each case')
+    parser.add_option('-n', '--samples', type='int', default=100,
+                      help='minimum number of timings of each case')
+    parser.add_option('-t', '--min-time', type='float', default=2e-5,
+                      help='minimum seconds of a timing, the faster '
+                      'operations are timed in batches')
+    parser.add_option('-s', '--save', metavar='FILE',
+                      help='save the results to FILE as json')
+    parser.add_option('-c', '--compare', metavar='FILE',
+                      help='compare with the results saved in FILE')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='slowdown reported as a regression (0.1=10%)')
+    parser.add_option('-l', '--list', action='store_true',
+                      help='list the cases')
+    (options, args) = parser.parse_args(args)
+    selected = [c for c in cases if not options.patterns
+                or [p for p in options.patterns if p in c.name]]
+    if options.list:
+        for c in selected:
+            print c.name
+        return 0
+    previous = {}
+    if options.compare:
+        previous = json.load(open(options.compare, 'rb'))['results']
+    print '%-38s %12s %10s %10s %10s' % (
+        'case', 'ops/s', 'p50 us', 'p90 us', 'p99 us')
+    results = {}
+    regressions = []
+    for c in selected:
+        result = results[c.name] = measure(c, options.duration,
+                                           options.min_time, options.samples)
+        before = previous.get(c.name)
+        print report(c.name, result, before)
+        sys.stdout.flush()
+        if before and result['ops'] < before['ops'] * (1 - options.threshold):
+            regressions.append(c.name)
+    if options.save:
+        data = dict(python=sys.version, platform=platform.platform(),
+                    time=time.strftime('%Y-%m-%d %H:%M:%S'), results=results)
+        json.dump(data, open(options.save, 'wb'), indent=1, sort_keys=True)
+    if regressions:
+        print '%s regressions: %s' % (len(regressions), ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""
+benchmark: the attribute accesses a page does on a FORMBUILDER
+(form.vars.x, form.errors.x, form.custom.widget.x, form.custom.label.x)
+with the current Storage and with the former Python level __getattr__.
+
+    python attributes.py [loops]
+"""
+import sys
+import time
+from formbuilder import storage
+from formbuilder import tablebuilder
+from formbuilder import tableform
+from formbuilder import validators
+
+class OldStorage(storage.Storage):
+    def __getattr__(self, key):
+        if key in self:
+            return self[key]
+        else:
+            return None
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+table = tablebuilder.Table(
+    "test_table",
+    tablebuilder.Field("name","string",default="hello",
+                       requires=validators.IS_NOT_EMPTY()),
+    tablebuilder.Field("age","integer",default=20,
+                       requires=validators.IS_INT_IN_RANGE(18,25)),
+    tablebuilder.Field("email","string",requires=validators.IS_EMAIL()),
+    tablebuilder.Field("mysex","boolean",default=False),
+    )
+names = table.fields
+
+def page(form):
+    # what a view does to lay out a custom form
+    for name in names:
+        form.custom.label[name]
+        form.custom.widget.name, form.custom.widget.age
+        form.custom.label.email, form.custom.comment.mysex
+        form.vars.name, form.vars.age, form.vars.email
+        form.errors.name, form.errors.age, form.errors.missing
+
+def timeit(form, loops):
+    t0 = time.time()
+    for i in xrange(loops):
+        page(form)
+    return (time.time() - t0) / loops * 1e6
+
+def convert(form, cls):
+    form.custom = cls((k, cls(v) if isinstance(v, dict) else v)
+                      for (k, v) in form.custom.items())
+    form.vars = cls(form.vars)
+    form.errors = cls(form.errors)
+    return form
+
+if __name__ == '__main__':
+    loops = len(sys.argv) > 1 and int(sys.argv[1]) or 20000
+    form = tableform.FORMBUILDER(table)
+    form.accepts({"name":"", "age":"40", "email":"a@b.com"})
+    messages = storage.Messages(lambda message: message.upper())
+    messages.submit = 'submit'
+    for (name, cls) in [('old Storage', OldStorage),
+                        ('Storage', storage.Storage)]:
+        print '%-12s %8.2f us/page' % (name, timeit(convert(form, cls), loops))
+    t0 = time.time()
+    for i in xrange(loops * 10):
+        messages.submit
+    print '%-12s %8.2f us/read' % \
+        ('Messages', (time.time() - t0) / loops / 10 * 1e6)
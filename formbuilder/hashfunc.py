@@ -8,11 +8,15 @@ License: LGPLv3 (http://www.gnu.org/licenses/lgpl.html)
 """
 
 import hashlib
+import hmac
+import struct
 import uuid
 import random
 import os
 import thread
+import threading
 import time
+from binascii import hexlify
 
 def md5_hash(text):
     """ Generate a md5 hash with the given text """
@@ -20,17 +24,73 @@ def md5_hash(text):
     return hashlib.md5(text).hexdigest()
 
 
+DIGESTS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha224': hashlib.sha224,
+    'sha256': hashlib.sha256,
+    'sha384': hashlib.sha384,
+    'sha512': hashlib.sha512,
+    }
+
+# empty digest objects by algorithm name, copied instead of looked up again
+_prototypes = {}
+
+# bytes read at once when hashing a file
+CHUNK_SIZE = 64 * 1024
+
+def new_digest(digest_alg='md5'):
+    """
+    returns a new, empty, hashlib object for the named algorithm
+    """
+    prototype = _prototypes.get(digest_alg)
+    if prototype is None:
+        prototype = _prototypes[digest_alg] = hashlib.new(digest_alg)
+    return prototype.copy()
+
+def update_digest(h, value, chunk_size=CHUNK_SIZE):
+    """
+    feeds value to the digest (or hmac) object h and returns h.
+
+    value can be a string, a file-like object (or a cgi.FieldStorage of an
+    upload), read by chunks and then rewound where it was, or any other
+    iterable of string chunks.
+    """
+    if isinstance(value, basestring):
+        h.update(value)
+        return h
+    if hasattr(value, 'file') and hasattr(value.file, 'read'):
+        value = value.file
+    if hasattr(value, 'read'):
+        try:
+            position = value.tell()
+        except (AttributeError, IOError):
+            position = None
+        read = value.read
+        chunk = read(chunk_size)
+        while chunk:
+            h.update(chunk)
+            chunk = read(chunk_size)
+        if position is not None:
+            value.seek(position)
+    else:
+        for chunk in value:
+            h.update(chunk)
+    return h
+
 def hash(text, digest_alg = 'md5'):
     """
     Generates hash with the given text using the specified
-    digest hashing algorithm
+    digest hashing algorithm. The text can also be a file or an iterable
+    of chunks (see update_digest)
     """
     if not isinstance(digest_alg,str):
-        h = digest_alg(text)
+        if isinstance(text, basestring):
+            return digest_alg(text).hexdigest()
+        h = digest_alg()
     else:
-        h = hashlib.new(digest_alg)
-        h.update(text)
-    return h.hexdigest()
+        h = new_digest(digest_alg)
+    return update_digest(h, text).hexdigest()
 
 def get_digest(value):
     """
@@ -38,36 +98,153 @@ def get_digest(value):
     """
     if not isinstance(value,str):
         return value
-    value = value.lower()
-    if value == "md5":
-        return hashlib.md5
-    elif value == "sha1":
-        return hashlib.sha1
-    elif value == "sha224":
-        return hashlib.sha224
-    elif value == "sha256":
-        return hashlib.sha256
-    elif value == "sha384":
-        return hashlib.sha384
-    elif value == "sha512":
-        return hashlib.sha512
-    else:
+    try:
+        return DIGESTS[value.lower()]
+    except KeyError:
         raise ValueError("Invalid digest algorithm")
 
-web2py_uuid_locker = thread.allocate_lock()
+def _pbkdf2(data, salt, iterations, keylen, digest_alg):
+    """ pure python PBKDF2 (RFC 2898), for pythons older than 2.7.8 """
+    prototype = hmac.new(data, None, get_digest(digest_alg))
+    def prf(message):
+        h = prototype.copy()
+        h.update(message)
+        return h.digest()
+    key = []
+    size = 0
+    block = 1
+    while size < keylen:
+        u = prf(salt + struct.pack('>I', block))
+        result = int(hexlify(u), 16)
+        for i in xrange(iterations - 1):
+            u = prf(u)
+            result ^= int(hexlify(u), 16)
+        key.append(('%%0%dx' % (2 * len(u))) % result)
+        size += len(u)
+        block += 1
+    return ''.join(key)[:2 * keylen]
+
+def pbkdf2_hex(data, salt, iterations=1000, keylen=20, digest_alg='sha1'):
+    """
+    returns the hex PBKDF2-HMAC key of length keylen derived from data
+    and salt. This is a module level function so it can be sent to a
+    process pool.
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf8')
+    if isinstance(salt, unicode):
+        salt = salt.encode('utf8')
+    # the parameters read from a stored hash may be unicode (from a database
+    # or json), hashlib wants str
+    digest_alg = str(digest_alg)
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        return hexlify(hashlib.pbkdf2_hmac(digest_alg.lower(), data, salt,
+                                           iterations, keylen))
+    return _pbkdf2(data, salt, iterations, keylen, digest_alg)
+
+def compare(a, b):
+    """ compares two strings in a time that does not depend on their content """
+    if isinstance(a, unicode):
+        a = a.encode('utf8')
+    if isinstance(b, unicode):
+        b = b.encode('utf8')
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for (x, y) in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
 node_id = uuid.getnode()
 milliseconds = int(time.time() * 1e3)
 
-def rotate(i):
-    a = random.randrange(256)
-    b = (node_id >> 4*i) % 256
-    c = (milliseconds >> 4*i) % 256
-    return (a + b + c) % 256
+# the random bytes of every uuid are mixed (xor) with the node id and the
+# start time, so two machines with a poor random source still differ
+UUID_MIX = int(''.join(['%02x' % ((node_id >> 4*i) + (milliseconds >> 4*i)
+                                  & 255) for i in range(16)]), 16)
+# bits of the uuid version 4 (random) and of the RFC 4122 variant
+UUID_CLEAR = ~((0xf000 << 64) | (0xc000 << 48))
+UUID_SET = (4 << 76) | (0x8000 << 48)
+# random bytes read at once by each thread
+UUID_BUFFER = 4096
 
-def web2py_uuid():
-    web2py_uuid_locker.acquire()
+_uuid_local = threading.local()
+
+def _uuid_refill(local):
+    """
+    fills the random buffer of the current thread. The buffer is dropped
+    when the process forks, so parent and child do not share uuids.
+    """
     try:
-        bytes = [chr(rotate(i)) for i in range(16)]
-        return str(uuid.UUID(bytes=bytes, version=4))
-    finally:
-        web2py_uuid_locker.release()
\ No newline at end of file
+        data = os.urandom(UUID_BUFFER)
+    except NotImplementedError:
+        # no system random source: one generator per thread
+        if not hasattr(local, 'random'):
+            local.random = random.Random('%s-%s-%s' % (
+                    os.getpid(), thread.get_ident(), time.time()))
+        data = ''.join([chr(local.random.randrange(256))
+                        for i in xrange(UUID_BUFFER)])
+    local.buffer = hexlify(data)
+    local.position = 0
+    local.pid = os.getpid()
+
+def web2py_uuid():
+    """
+    returns a random (version 4) uuid string. Each thread reads its own
+    buffer of random bytes, so no lock is taken.
+    """
+    local = _uuid_local
+    position = getattr(local, 'position', None)
+    if position is None or position >= len(local.buffer) \
+            or local.pid != os.getpid():
+        _uuid_refill(local)
+        position = 0
+    local.position = position + 32
+    n = (int(local.buffer[position:position + 32], 16) ^ UUID_MIX) \
+        & UUID_CLEAR | UUID_SET
+    h = '%032x' % n
+    return '%s-%s-%s-%s-%s' % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+if __name__ == '__main__':
+    # throughput of web2py_uuid with several threads, compared with the
+    # former implementation that took a global lock on every call
+    #     python hashfunc.py [calls per thread]
+    import sys
+    calls = len(sys.argv) > 1 and int(sys.argv[1]) or 50000
+    locker = thread.allocate_lock()
+
+    def rotate(i):
+        a = random.randrange(256)
+        b = (node_id >> 4*i) % 256
+        c = (milliseconds >> 4*i) % 256
+        return (a + b + c) % 256
+
+    def locked_uuid():
+        locker.acquire()
+        try:
+            bytes = [chr(rotate(i)) for i in range(16)]
+            return str(uuid.UUID(bytes=bytes, version=4))
+        finally:
+            locker.release()
+
+    def run(function, results):
+        results.extend([function() for i in xrange(calls)])
+
+    u = uuid.UUID(web2py_uuid())
+    assert u.version == 4 and u.variant == uuid.RFC_4122
+    for nthreads in (1, 2, 4, 8):
+        for (name, function) in [('locked', locked_uuid),
+                                 ('web2py_uuid', web2py_uuid)]:
+            results = []
+            threads = [threading.Thread(target=run, args=(function, results))
+                       for i in range(nthreads)]
+            t0 = time.time()
+            for t in threads: t.start()
+            for t in threads: t.join()
+            elapsed = time.time() - t0
+            assert len(set(results)) == len(results)
+            print '%s threads %-12s %10.0f uuids/s' % \
+                (nthreads, name, len(results) / elapsed)
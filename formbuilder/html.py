@@ -1,12 +1,16 @@
 #!/usr/bin/python
 #coding:utf-8
+import os
 import re
+import sys
 import cgi
 import itertools
 from storage import Storage
 from HTMLParser import HTMLParser
 import decoder
 import base64
+import instrument
+from uploads import iter_chunks
 
 __all__ = [
     'A',
@@ -67,6 +71,7 @@ __all__ = [
     'XML',
     'xmlescape',
     'embed64',
+    'iter_embed64',
     ]
 
 ON = True
@@ -295,6 +300,10 @@ class DIV(XmlComponent):
     # contain components
     tag = 'div'
 
+    # results of the validators already run by FORM._prevalidate,
+    # by id of the INPUT, set only while a form is being accepted
+    prevalidated = None
+
     def __init__(self, *components, **attributes):
         """
         :param *components: any components that should be nested in this element
@@ -467,6 +476,7 @@ class DIV(XmlComponent):
                 c.errors = self.errors
                 c.latest = self.latest
                 c.formname = self.formname
+                c.prevalidated = self.prevalidated
                 c['hideerror']=hideerror
                 newstatus = c._traverse(status,hideerror) and newstatus
 
@@ -535,6 +545,9 @@ class DIV(XmlComponent):
         generates the xml for this component.
         """
 
+        if instrument.sink is not None and not instrument.rendering():
+            return instrument.render(self.xml, 'xml', tag=self.tag)
+
         (fa, co) = self._xml()
 
         if not self.tag:
@@ -1229,33 +1242,54 @@ class INPUT(DIV):
         if name is None or name == '':
             return True
         name = str(name)
+        sink = instrument.sink
+        if sink is not None:
+            t0 = instrument.timer()
 
+        value = self._request_value(self.request_vars)
         if self['_type'] != 'checkbox':
             self['old_value'] = self['value'] or self['_value'] or ''
-            value = self.request_vars.get(name, '')
             self['value'] = value
         else:
             self['old_value'] = self['value'] or False
-            value = self.request_vars.get(name)
             if isinstance(value, (tuple, list)):
                 self['value'] = self['_value'] in value
             else:
                 self['value'] = self['_value'] == value
         requires = self['requires']
-        if requires:
+        if requires and self.prevalidated and id(self) in self.prevalidated:
+            (value, errors) = self.prevalidated[id(self)]
+            if errors != None:
+                self.vars[name] = value
+                self.errors[name] = errors
+        elif requires:
             if not isinstance(requires, (list, tuple)):
                 requires = [requires]
             for validator in requires:
-                (value, errors) = validator(value)
+                if sink is None:
+                    (value, errors) = validator(value)
+                else:
+                    (value, errors) = instrument.call_validator(validator,
+                                                                value, name)
                 if errors != None:
                     self.vars[name] = value
                     self.errors[name] = errors
                     break
+        if sink is not None:
+            sink.timing('field.validate', instrument.timer() - t0, field=name)
         if not name in self.errors:
             self.vars[name] = value
             return True
         return False
 
+    def _request_value(self, request_vars):
+        """
+        the value of this input in request_vars, as given to the validators
+        """
+        if self['_type'] != 'checkbox':
+            return request_vars.get(str(self['_name']), '')
+        return request_vars.get(str(self['_name']))
+
     def _postprocessing(self):
         t = self['_type']
         if not t:
@@ -1409,6 +1443,56 @@ class LEGEND(DIV):
     tag = 'legend'
 
 
+def _inputs(component):
+    """ all the INPUT, TEXTAREA and SELECT in component """
+    for c in component.components:
+        if isinstance(c, INPUT):
+            yield c
+        elif isinstance(c, DIV):
+            for i in _inputs(c):
+                yield i
+
+
+def _launch_acall(validator, value):
+    if hasattr(validator, '__acall__'):
+        return validator.__acall__(value)
+    return None
+
+
+def _check_thread_executor(executor):
+    """
+    the io_bound validators hold database connections (IS_IN_DB) or get
+    uploads (IS_IMAGE), they cannot be pickled to another process
+    """
+    pool = sys.modules.get('multiprocessing.pool')
+    if executor.__class__.__name__ == 'ProcessPoolExecutor' or pool and \
+            isinstance(executor, pool.Pool) and \
+            not isinstance(executor, pool.ThreadPool):
+        raise SyntaxError, 'accepts needs a thread executor ' \
+            '(ThreadPool or ThreadPoolExecutor), not %s' % executor
+
+
+def _io_bound_launcher(executor, launch=None):
+    _check_thread_executor(executor)
+    def launch_io_bound(validator, value):
+        if launch:
+            future = launch(validator, value)
+            if future is not None:
+                return future
+        if not getattr(validator, 'io_bound', False):
+            return None
+        if hasattr(executor, 'submit'):
+            return executor.submit(validator, value)
+        return executor.apply_async(validator, (value,))
+    return launch_io_bound
+
+
+def _wait(future):
+    if hasattr(future, 'result'):
+        return future.result()
+    return future.get()
+
+
 class FORM(DIV):
 
     """
@@ -1445,7 +1529,18 @@ class FORM(DIV):
         keepvalues=False,
         onvalidation=None,
         hideerror=False,
+        executor=None,
         ):
+        """
+        validates vars and returns True if they are accepted.
+
+        with an executor (a concurrent.futures ThreadPoolExecutor or a
+        multiprocessing.pool.ThreadPool) the validators marked io_bound
+        run on the executor, the slow checks of the different fields at the
+        same time. vars and errors are the same as without it. The
+        executor must run threads of this process: a process pool raises
+        SyntaxError, the validators and the values cannot be pickled.
+        """
         if vars.__class__.__name__ == 'Request':
             vars=vars.post_vars
         self.errors.clear()
@@ -1458,7 +1553,26 @@ class FORM(DIV):
         # check formname and formkey
 
         status = True
-        status = self._traverse(status,hideerror)
+        sink = instrument.sink
+        launch = self._launch
+        if executor:
+            launch = _io_bound_launcher(executor, launch)
+        if launch:
+            if sink is not None:
+                t0 = instrument.timer()
+            self.prevalidated = self._prevalidate(launch)
+            if sink is not None:
+                sink.timing('form.prevalidate', instrument.timer() - t0,
+                            form=self['_id'])
+        if sink is not None:
+            t0 = instrument.timer()
+        try:
+            status = self._traverse(status,hideerror)
+        finally:
+            self.prevalidated = None
+        if sink is not None:
+            sink.timing('form.traverse', instrument.timer() - t0,
+                        form=self['_id'])
         if onvalidation:
             if isinstance(onvalidation, dict):
                 onsuccess = onvalidation.get('onsuccess', None)
@@ -1479,6 +1593,69 @@ class FORM(DIV):
             self._traverse(False,hideerror)
         return status
 
+    # set by accepts_async, see _prevalidate
+    _launch = None
+
+    def accepts_async(self, vars, *args, **kwargs):
+        """
+        same as accepts, but the validators with an __acall__ method are
+        started for all the fields before any of them is waited for, so a
+        form with several database checks waits for the slowest one, not
+        for their sum. The other validators run inline, as in accepts.
+
+        validator.__acall__(value) returns a future: an object with a
+        result() (like concurrent.futures) or a get() (like the
+        multiprocessing AsyncResult) method returning (value, error).
+        """
+        self._launch = _launch_acall
+        try:
+            return self.accepts(vars, *args, **kwargs)
+        finally:
+            del self._launch
+
+    def _prevalidate(self, launch):
+        """
+        runs the validators of all the inputs in rounds: in each round
+        every input runs its validators inline up to the first one for
+        which launch(validator, value) returns a future, then all the
+        futures of the round are waited for. Returns the (value, error)
+        of every input with validators, by id of the input; _validate
+        uses them instead of calling the validators again.
+        """
+        chains = []
+        for c in _inputs(self):
+            requires = c['requires']
+            if not c['_name'] or not requires:
+                continue
+            if not isinstance(requires, (list, tuple)):
+                requires = [requires]
+            chains.append((c, requires, 0,
+                           c._request_value(self.request_vars)))
+        results = {}
+        while chains:
+            waiting = []
+            for (c, requires, i, value) in chains:
+                (future, errors) = (None, None)
+                while i < len(requires):
+                    future = launch(requires[i], value)
+                    if future is not None:
+                        waiting.append((c, requires, i, future))
+                        break
+                    (value, errors) = requires[i](value)
+                    if errors != None:
+                        break
+                    i += 1
+                if future is None or errors != None:
+                    results[id(c)] = (value, errors)
+            chains = []
+            for (c, requires, i, future) in waiting:
+                (value, errors) = _wait(future)
+                if errors != None or i + 1 == len(requires):
+                    results[id(c)] = (value, errors)
+                else:
+                    chains.append((c, requires, i + 1, value))
+        return results
+
     def _postprocessing(self):
         if not '_action' in self.attributes:
             self['_action'] = ''
@@ -1503,6 +1680,8 @@ class FORM(DIV):
         return DIV(c, _class="hidden")
 
     def xml(self):
+        if instrument.sink is not None and not instrument.rendering():
+            return instrument.render(self.xml, 'form.xml', form=self['_id'])
         newform = FORM(*self.components, **self.attributes)
         hidden_fields = self.hidden_fields()
         if hidden_fields.components:
@@ -1656,14 +1835,46 @@ def embed64(
     :param filename: if provided, opens and reads this file in 'rb' mode
     :param file: if provided, reads this file
     :param data: if provided, uses the provided data
+
+    the files are mapped (see uploads.mapped), not read into a string, see
+    iter_embed64 to write the result in chunks
     """
 
-    if filename and os.path.exists(file):
-        fp = open(filename, 'rb')
-        data = fp.read()
-        fp.close()
-    data = base64.b64encode(data)
-    return 'data:%s;base64,%s' % (extension, data)
+    return ''.join(iter_embed64(filename, file, data, extension))
+
+
+def iter_embed64(
+    filename = None,
+    file = None,
+    data = None,
+    extension = 'image/gif',
+    chunk_size = 3 * 2 ** 16,
+    ):
+    """
+    like embed64, but yields the data uri in chunks, encoding chunk_size
+    bytes (rounded to a multiple of 3, so the chunks can be joined) at a
+    time::
+
+        for chunk in iter_embed64('logo.png', extension='image/png'):
+            response.write(chunk)
+    """
+
+    chunk_size = max(3, chunk_size - chunk_size % 3)
+    yield 'data:%s;base64,' % extension
+    fp = None
+    if filename and os.path.exists(filename):
+        fp = file = open(filename, 'rb')
+    try:
+        if file is not None:
+            chunks = iter_chunks(file, chunk_size)
+        else:
+            chunks = (data[i:i + chunk_size]
+                      for i in xrange(0, len(data or ''), chunk_size))
+        for chunk in chunks:
+            yield base64.b64encode(chunk)
+    finally:
+        if fp:
+            fp.close()
 
 
 if __name__ == '__main__':
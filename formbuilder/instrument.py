@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Optional timings of the work done by the forms.
+
+    import instrument
+    collector = instrument.Collector()
+    instrument.set_sink(collector)
+    form = FORMBUILDER(db.person)
+    form.accepts(request.vars)
+    html = form.xml()
+    print collector.report()
+
+While no sink is set (the default) every hook only checks that
+instrument.sink is None.
+
+The timings, in seconds, have a name and some tags:
+
+- formbuilder.init (table): FORMBUILDER construction
+- formbuilder.widget (table, field): building the widget of a field,
+  including its options
+- formbuilder.accepts (table): FORMBUILDER.accepts
+- formbuilder.rerender (table): rebuilding the widgets after errors
+- form.prevalidate (form): the concurrent validators, see accepts_async
+- form.traverse (form): the validation of all the fields
+- field.validate (field): the validation of one field
+- validator (field, validator): one call of a validator
+- form.xml (form): serialization of a form
+- xml (tag): serialization of any other component (DIV, TABLE, a widget
+  rendered on its own...)
+
+only the outermost xml() of a thread is timed, the components inside it
+are part of its timing.
+
+A sink is any object with a timing(name, seconds, **tags) method:
+Collector keeps them in memory, LoggingSink logs them and CallbackSink
+passes them to a function, for instance a statsd client.
+
+profile_table runs the validators of a table on sample data and reports
+which validators cost the most and how often each rejects the values.
+"""
+
+import time
+import logging
+import threading
+
+sink = None
+timer = time.time
+
+def set_sink(new_sink):
+    """ sets the sink of the timings, None disables them """
+    global sink
+    sink = new_sink
+
+
+def timing(name, seconds, **tags):
+    if sink is not None:
+        sink.timing(name, seconds, **tags)
+
+
+def call_validator(validator, value, field):
+    """ calls validator(value) and times it """
+    t0 = timer()
+    try:
+        return validator(value)
+    finally:
+        timing('validator', timer() - t0, field=field,
+               validator=validator.__class__.__name__)
+
+
+_rendering = threading.local()
+
+def rendering():
+    """ True while the current thread serializes a timed component """
+    return getattr(_rendering, 'active', False)
+
+
+def render(xml, name, **tags):
+    """
+    calls xml() and times it; the components serialized by it see
+    rendering() True and are not timed on their own
+    """
+    _rendering.active = True
+    t0 = timer()
+    try:
+        result = xml()
+    finally:
+        _rendering.active = False
+    timing(name, timer() - t0, **tags)
+    return result
+
+
+class Collector(object):
+    """
+    keeps, for every name and tags, the number of timings, their total and
+    their maximum
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stats = {}
+
+    def timing(self, name, seconds, **tags):
+        key = (name, tuple(sorted(tags.items())))
+        self.lock.acquire()
+        try:
+            stats = self.stats.get(key)
+            if stats is None:
+                self.stats[key] = [1, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = max(stats[2], seconds)
+        finally:
+            self.lock.release()
+
+    def get(self, name, **tags):
+        """ returns (count, total, max) of the timings of name with tags """
+        stats = self.stats.get((name, tuple(sorted(tags.items()))))
+        return stats and tuple(stats) or (0, 0.0, 0.0)
+
+    def items(self):
+        """ [(name, tags, count, total, max)] ordered by total time """
+        self.lock.acquire()
+        try:
+            items = [(name, dict(tags), count, total, maximum)
+                     for ((name, tags), (count, total, maximum))
+                     in self.stats.items()]
+        finally:
+            self.lock.release()
+        items.sort(key=lambda item: -item[3])
+        return items
+
+    def report(self):
+        lines = ['%-20s %-40s %8s %12s %12s' % ('name', 'tags', 'count',
+                                                'total ms', 'max ms')]
+        for (name, tags, count, total, maximum) in self.items():
+            tags = ','.join(['%s=%s' % item for item in sorted(tags.items())])
+            lines.append('%-20s %-40s %8d %12.3f %12.3f' % (
+                    name, tags, count, total * 1000, maximum * 1000))
+        return '\n'.join(lines)
+
+
+class LoggingSink(object):
+    """ logs every timing """
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('formbuilder')
+        self.level = level
+
+    def timing(self, name, seconds, **tags):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, '%s %.3fms %s', name, seconds * 1000,
+                            ' '.join(['%s=%s' % item
+                                      for item in sorted(tags.items())]))
+
+
+class CallbackSink(object):
+    """
+    calls callback(name, seconds, tags) for every timing, for example::
+
+        instrument.set_sink(instrument.CallbackSink(
+            lambda name, seconds, tags: statsd.timing(name, seconds * 1000)))
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def timing(self, name, seconds, **tags):
+        self.callback(name, seconds, tags)
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class TableProfile(object):
+    """
+    the result of profile_table. rows has one Storage for every validator:
+
+    - field, position (in requires), validator (class name)
+    - calls: number of values it validated
+    - skipped: number of values rejected by a previous validator
+    - mean, p99: seconds per call
+    - rejected: fraction of its calls returning an error (these stop the
+      chain, the short-circuit rate)
+    - share: fraction of the validation time of the field spent in it
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def dominant(self, share=0.5):
+        """ the validators taking more than share of the time of their field """
+        return [row for row in self.rows if row.share > share]
+
+    def suggestions(self):
+        """
+        pairs of validators of a field where the later one is cheaper and
+        rejects more often, so moving it first would reject bad values
+        sooner. Validators that change the value (IS_INT_IN_RANGE returns
+        an int, CLEANUP, IS_LOWER...) cannot always be moved, check before
+        reordering.
+        """
+        suggestions = []
+        for a in self.rows:
+            for b in self.rows:
+                if a.field == b.field and a.position < b.position \
+                        and b.mean < a.mean and b.rejected > a.rejected:
+                    suggestions.append('%s: %s (%.1fus, rejects %.0f%%) '
+                                       'before %s (%.1fus, rejects %.0f%%)' % (
+                            a.field, b.validator, b.mean * 1e6,
+                            b.rejected * 100, a.validator, a.mean * 1e6,
+                            a.rejected * 100))
+        return suggestions
+
+    def report(self):
+        lines = ['%-20s %-24s %7s %7s %10s %10s %8s %7s' % (
+                'field', 'validator', 'calls', 'skipped', 'mean us',
+                'p99 us', 'rejected', 'share')]
+        for row in self.rows:
+            lines.append('%-20s %-24s %7d %7d %10.1f %10.1f %7.0f%% %6.0f%%%s' % (
+                    row.field, '%s.%s' % (row.position, row.validator),
+                    row.calls, row.skipped, row.mean * 1e6, row.p99 * 1e6,
+                    row.rejected * 100, row.share * 100,
+                    row.share > 0.5 and ' *' or ''))
+        suggestions = self.suggestions()
+        if suggestions:
+            lines.append('')
+            lines.append('consider moving first:')
+            lines.extend(['  ' + s for s in suggestions])
+        return '\n'.join(lines)
+
+    __str__ = report
+
+
+def profile_table(table, sample_inputs, repeat=1, fields=None):
+    """
+    runs the validators (requires) of the fields of table on every sample
+    of sample_inputs (a list of request vars dicts, like the ones given to
+    accepts) repeat times, timing each validator, and returns a
+    TableProfile::
+
+        print profile_table(db.person, [dict(email='a@b.com'), {}], 100)
+    """
+    from storage import Storage
+    from tablebuilder import collapse_vars, request_value
+    samples = [collapse_vars(table, sample) for sample in sample_inputs]
+    rows = []
+    for field in table:
+        if fields and not field.name in fields:
+            continue
+        requires = field.requires
+        if not requires:
+            continue
+        if not isinstance(requires, (list, tuple)):
+            requires = [requires]
+        times = [[] for validator in requires]
+        rejected = [0] * len(requires)
+        for r in xrange(repeat):
+            for sample in samples:
+                value = request_value(field, sample)
+                for (i, validator) in enumerate(requires):
+                    t0 = timer()
+                    (value, error) = validator(value)
+                    times[i].append(timer() - t0)
+                    if error is not None:
+                        rejected[i] += 1
+                        break
+        total = sum([sum(t) for t in times]) or 1.0
+        runs = repeat * len(samples)
+        for (i, validator) in enumerate(requires):
+            calls = len(times[i])
+            rows.append(Storage(
+                    field=field.name, position=i,
+                    validator=validator.__class__.__name__,
+                    calls=calls, skipped=runs - calls,
+                    mean=calls and sum(times[i]) / calls or 0.0,
+                    p99=calls and _percentile(times[i], 99) or 0.0,
+                    rejected=calls and float(rejected[i]) / calls or 0.0,
+                    share=sum(times[i]) / total))
+    return TableProfile(rows)
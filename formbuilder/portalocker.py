@@ -26,6 +26,15 @@ Methods:
    lock( file, flags )
    unlock( file )
 
+To wait for a lock at most a few seconds:
+
+   lock = portalocker.locked(file, portalocker.LOCK_SH, timeout=2)
+   with lock:  # or lock.acquire() and lock.release()
+       data = file.read()
+
+locked raises LockTimeout when the lock is not acquired in time, and
+records how long the locks are waited for and held (see lock_stats).
+
 Constants:
 
    LOCK_EX
@@ -41,8 +50,11 @@ Version: $Id: portalocker.py,v 1.3 2001/05/29 18:47:55 Administrator Exp $
 """
 
 import os
+import time
+import errno
 import logging
 import platform
+import threading
 logger = logging.getLogger("web2py")
 
 os_locking = None
@@ -76,6 +88,9 @@ if os_locking == 'windows':
         hfile = win32file._get_osfhandle(file.fileno())
         win32file.UnlockFileEx(hfile, 0, 0x7fff0000, __overlapped)
 
+    def _is_busy(e):
+        return isinstance(e, pywintypes.error)
+
 
 elif os_locking == 'posix':
     LOCK_EX = fcntl.LOCK_EX
@@ -88,6 +103,10 @@ elif os_locking == 'posix':
     def unlock(file):
         fcntl.flock(file.fileno(), fcntl.LOCK_UN)
 
+    def _is_busy(e):
+        return isinstance(e, IOError) and \
+            e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK)
+
 
 else:
     if platform.system() == 'Windows':
@@ -105,6 +124,122 @@ else:
     def unlock(file):
         pass
 
+    def _is_busy(e):
+        return False
+
+
+class LockTimeout(IOError):
+    pass
+
+
+class LockStats(object):
+    """
+    counters of the locks taken with locked, by mode ('shared' or
+    'exclusive'): number of locks acquired, of timeouts, total and maximum
+    seconds spent waiting for and holding the locks.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stats = {}
+
+    def _record(self, mode, **values):
+        self._lock.acquire()
+        try:
+            stats = self.stats.get(mode)
+            if stats is None:
+                stats = self.stats[mode] = dict(
+                    acquired=0, timeouts=0, wait=0.0, max_wait=0.0,
+                    hold=0.0, max_hold=0.0)
+            for (key, value) in values.items():
+                if key.startswith('max_'):
+                    stats[key] = max(stats[key], value)
+                else:
+                    stats[key] += value
+        finally:
+            self._lock.release()
+
+    def __call__(self):
+        """ returns a copy of the counters """
+        self._lock.acquire()
+        try:
+            return dict((mode, dict(stats))
+                        for (mode, stats) in self.stats.items())
+        finally:
+            self._lock.release()
+
+lock_stats = LockStats()
+
+
+class locked(object):
+    """
+    lock(file, flags) for the time of a with block, or between acquire()
+    and release().
+
+    With timeout=None it waits as long as needed, like lock. Otherwise the
+    lock is tried without blocking (LOCK_NB) every backoff seconds, the
+    delay doubling up to max_backoff, and LockTimeout is raised after
+    timeout seconds.
+    """
+
+    def __init__(self, file, flags=LOCK_EX, timeout=None,
+                 backoff=0.001, max_backoff=0.1):
+        self.file = file
+        self.flags = flags
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        if LOCK_EX is not None and not flags & LOCK_EX:
+            self.mode = 'shared'
+        else:
+            self.mode = 'exclusive'
+        self.acquired_at = None
+
+    def acquire(self):
+        start = time.time()
+        if self.timeout is None or LOCK_NB is None:
+            lock(self.file, self.flags)
+        else:
+            delay = self.backoff
+            while True:
+                try:
+                    lock(self.file, self.flags | LOCK_NB)
+                    break
+                except Exception, e:
+                    if not _is_busy(e):
+                        raise
+                waited = time.time() - start
+                if waited >= self.timeout:
+                    lock_stats._record(self.mode, timeouts=1, wait=waited,
+                                       max_wait=waited)
+                    raise LockTimeout, 'lock on %s not acquired in %ss' \
+                        % (getattr(self.file, 'name', self.file), self.timeout)
+                time.sleep(min(delay, self.timeout - waited))
+                delay = min(delay * 2, self.max_backoff)
+        self.acquired_at = time.time()
+        waited = self.acquired_at - start
+        lock_stats._record(self.mode, acquired=1, wait=waited,
+                           max_wait=waited)
+        return self
+
+    def release(self):
+        if self.acquired_at is None:
+            raise RuntimeError, 'release of a lock not acquired: %s' \
+                % getattr(self.file, 'name', self.file)
+        unlock(self.file)
+        held = time.time() - self.acquired_at
+        self.acquired_at = None
+        lock_stats._record(self.mode, hold=held, max_hold=held)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
 
 if __name__ == '__main__':
     from time import time, strftime, localtime
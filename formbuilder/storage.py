@@ -12,11 +12,22 @@ Provides:
 - Storage; like dictionary allowing also for `obj.foo` for `obj['foo']`
 """
 
+import os
+import errno
+import copy_reg
+import datetime
+import decimal
+import threading
+import mmap as _mmap
+import marshal
+import struct
+import tempfile
 import cPickle
 import portalocker
 
 __all__ = ['List', 'Storage', 'Settings', 'Messages',
-           'StorageList', 'load_storage', 'save_storage']
+           'StorageList', 'load_storage', 'save_storage',
+           'loads_storage', 'dumps_storage', 'LRUCache']
 
 
 class List(list):
@@ -55,14 +66,11 @@ class Storage(dict):
 
     """
 
-    def __getattr__(self, key):
-        if key in self:
-            return self[key]
-        else:
-            return None
+    # only called when the normal attribute lookup fails, dict.get does the
+    # single hash lookup in C and returns None for the missing keys
+    __getattr__ = dict.get
 
-    def __setattr__(self, key, value):
-        self[key] = value
+    __setattr__ = dict.__setitem__
 
     def __delattr__(self, key):
         if key in self:
@@ -80,6 +88,13 @@ class Storage(dict):
         for (k, v) in value.items():
             self[k] = v
 
+    # pickle protocol 2 looks up __getnewargs__, which __getattr__ answers
+    # with None, so the reduction is explicit: a new empty object (without
+    # calling __init__) and its items
+    def __reduce_ex__(self, protocol):
+        return (copy_reg.__newobj__, (self.__class__,), None, None,
+                self.iteritems())
+
     def getlist(self, obj):
         """Returns a list given a request.vars style object attribute.
 
@@ -148,6 +163,98 @@ class Storage(dict):
             return value[-1]
         return None
 
+class LRUCache(object):
+    """
+    a thread safe dictionary keeping the maxsize most recently used keys
+
+        >>> cache = LRUCache(2)
+        >>> cache.set('a', 1); cache.set('b', 2); cache.get('a')
+        1
+        >>> cache.set('c', 3); print cache.get('b')
+        None
+        >>> cache.stats()['hits'], cache.stats()['misses']
+        (1, 1)
+    """
+
+    # the keys are in a circular doubly linked list, from the least to the
+    # most recently used, a link is [previous, next, key, value]
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.links = {}
+            self.root = root = []
+            root[:] = [root, root, None, None]
+            self.hits = self.misses = 0
+        finally:
+            self.lock.release()
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            (previous, next) = link[:2]
+            previous[1] = next
+            next[0] = previous
+            root = self.root
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.lock.acquire()
+        try:
+            link = self.links.pop(key, None)
+            if link is not None:
+                (previous, next) = link[:2]
+                previous[1] = next
+                next[0] = previous
+            elif len(self.links) >= self.maxsize:
+                oldest = self.root[1]
+                if oldest is not self.root:
+                    self.root[1] = oldest[1]
+                    oldest[1][0] = self.root
+                    del self.links[oldest[2]]
+            root = self.root
+            last = root[0]
+            link = [last, root, key, value]
+            last[1] = root[0] = self.links[key] = link
+        finally:
+            self.lock.release()
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def __len__(self):
+        return len(self.links)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self.links), maxsize=self.maxsize)
+
+    # a cache is pickled empty
+    def __getstate__(self):
+        return dict(maxsize=self.maxsize)
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+
 class StorageList(Storage):
     """
     like Storage but missing elements default to [] instead of None
@@ -159,21 +266,237 @@ class StorageList(Storage):
             self[key]=[]
             return self[key]
 
-def load_storage(filename):
-    fp = open(filename, 'rb')
-    portalocker.lock(fp, portalocker.LOCK_EX)
-    storage = cPickle.load(fp)
-    portalocker.unlock(fp)
-    fp.close()
-    return Storage(storage)
+# storage file format:
+#   'FBST' | format version (1 byte) | marshal version (1 byte) | marshal data
+# the plain python types (str, unicode, int, long, float, bool, None, and
+# dict, list, tuple, set of them) are saved as they are. The other values
+# are saved as tuples starting with STORAGE_TAG: the datetimes, dates,
+# times, Decimals and List by value, any other object pickled. Loading a
+# storage file never runs code unless it holds pickled values, which
+# loads_storage(..., allow_pickle=False) refuses.
+STORAGE_MAGIC = 'FBST'
+STORAGE_VERSION = 2
+STORAGE_HEADER = struct.Struct('4sBB')
+STORAGE_TAG = '\0FBST'
+STORAGE_LOCK = '.storage.lock'
+
+_scalars = frozenset([str, unicode, int, long, float, bool, complex,
+                      type(None)])
+
+
+def _plain(obj):
+    """
+    converts obj into the types marshal saves: the nested Storage objects
+    become dicts and the other values tagged tuples
+    """
+    t = type(obj)
+    if t in _scalars:
+        return obj
+    elif t is dict or isinstance(obj, Storage):
+        return dict((_plain(k), _plain(v)) for (k, v) in obj.iteritems())
+    elif t is list:
+        return [_plain(v) for v in obj]
+    elif t is List:
+        return (STORAGE_TAG, 'List', [_plain(v) for v in obj])
+    elif t is tuple:
+        obj = tuple([_plain(v) for v in obj])
+        if obj and obj[0] == STORAGE_TAG:
+            return (STORAGE_TAG, 'tuple', obj)
+        return obj
+    elif t in (set, frozenset) and \
+            not [v for v in obj if not type(v) in _scalars]:
+        return obj
+    elif t is datetime.datetime and obj.tzinfo is None:
+        return (STORAGE_TAG, 'datetime', obj.timetuple()[:6]
+                + (obj.microsecond,))
+    elif t is datetime.date:
+        return (STORAGE_TAG, 'date', (obj.year, obj.month, obj.day))
+    elif t is datetime.time and obj.tzinfo is None:
+        return (STORAGE_TAG, 'time', (obj.hour, obj.minute, obj.second,
+                                      obj.microsecond))
+    elif t is decimal.Decimal:
+        return (STORAGE_TAG, 'decimal', str(obj))
+    return (STORAGE_TAG, 'pickle', cPickle.dumps(obj, 2))
+
+
+def _tagged(obj, allow_pickle):
+    """ the value of a tuple saved by _plain with STORAGE_TAG """
+    (tag, kind, value) = obj
+    if kind == 'List':
+        return List(_storage(value, allow_pickle))
+    elif kind == 'tuple':
+        return tuple([_storage(v, allow_pickle) for v in value])
+    elif kind == 'datetime':
+        return datetime.datetime(*value)
+    elif kind == 'date':
+        return datetime.date(*value)
+    elif kind == 'time':
+        return datetime.time(*value)
+    elif kind == 'decimal':
+        return decimal.Decimal(value)
+    elif kind == 'pickle':
+        if not allow_pickle:
+            raise ValueError, 'the storage file holds pickled values ' \
+                '(only loaded with allow_pickle=True)'
+        return cPickle.loads(value)
+    raise ValueError, 'unknown value type in storage file: %s' % kind
+
+
+def _storage(obj, allow_pickle=True):
+    """
+    the inverse of _plain: the dicts are loaded as Storage objects. The
+    freshly unmarshalled containers are not shared, so they are updated in
+    place and only the values that are containers are visited.
+    """
+    if type(obj) is dict:
+        keys = None
+        for (k, v) in obj.iteritems():
+            if type(v) in _containers:
+                obj[k] = _storage(v, allow_pickle)
+            if type(k) is tuple:
+                keys = (keys or []) + [k]
+        for k in keys or []:
+            obj[_storage(k, allow_pickle)] = obj.pop(k)
+        return Storage(obj)
+    elif type(obj) is list:
+        for (i, v) in enumerate(obj):
+            if type(v) in _containers:
+                obj[i] = _storage(v, allow_pickle)
+        return obj
+    elif type(obj) is tuple:
+        if len(obj) == 3 and obj[0] == STORAGE_TAG:
+            return _tagged(obj, allow_pickle)
+        return tuple([_storage(v, allow_pickle) for v in obj])
+    return obj
+
+_containers = (dict, list, tuple)
+
+
+def dumps_storage(storage):
+    return STORAGE_HEADER.pack(STORAGE_MAGIC, STORAGE_VERSION,
+                               marshal.version) + \
+        marshal.dumps(_plain(storage), marshal.version)
+
+
+def loads_storage(data, allow_pickle=True):
+    """
+    data is a string or a buffer (like a mmap) with the content of a storage
+    file, unmarshalled in place, without copying it.
 
+    the pickled values (objects of other types) and the files saved by the
+    old, pickle based, save_storage are loaded too: pickles run code, so
+    with data from an untrusted source pass allow_pickle=False, they then
+    raise ValueError. To convert the old files once::
 
-def save_storage(storage, filename):
-    fp = open(filename, 'wb')
-    portalocker.lock(fp, portalocker.LOCK_EX)
-    cPickle.dump(dict(storage), fp)
-    portalocker.unlock(fp)
-    fp.close()
+        save_storage(load_storage(filename), filename)
+    """
+    size = STORAGE_HEADER.size
+    if data[:4] != STORAGE_MAGIC:
+        if not allow_pickle:
+            raise ValueError, 'not a storage file (pickle files are only ' \
+                'loaded with allow_pickle=True)'
+        return Storage(cPickle.loads(data[:]))
+    (magic, version, marshal_version) = STORAGE_HEADER.unpack(data[:size])
+    if version > STORAGE_VERSION or marshal_version > marshal.version:
+        raise ValueError, 'unsupported storage file version %s/%s' \
+            % (version, marshal_version)
+    obj = marshal.loads(buffer(data, size))
+    if version == 1:
+        # no tagged values
+        return _storage(obj, False)
+    return _storage(obj, allow_pickle)
+
+
+def load_storage(filename, mmap=False, allow_pickle=True, timeout=None):
+    """
+    loads a Storage saved by save_storage.
+
+    readers only take a shared lock, so they do not block each other; the
+    lock still keeps them away from a legacy writer updating the file in
+    place. With mmap=True the file is mapped instead of read, so the
+    processes loading the same read-mostly file share its pages.
+    With a timeout (seconds) portalocker.LockTimeout is raised if the lock
+    cannot be taken in time.
+    """
+    fp = open(filename, 'rb')
+    try:
+        lock = portalocker.locked(fp, portalocker.LOCK_SH, timeout)
+        lock.acquire()
+        try:
+            if mmap and os.fstat(fp.fileno()).st_size:
+                data = _mmap.mmap(fp.fileno(), 0, access=_mmap.ACCESS_READ)
+                try:
+                    return loads_storage(data, allow_pickle)
+                finally:
+                    data.close()
+            return loads_storage(fp.read(), allow_pickle)
+        finally:
+            lock.release()
+    finally:
+        fp.close()
+
+
+def _mkstemp(filename):
+    """
+    like tempfile.mkstemp, in the folder of filename, but the file gets the
+    mode of a new file (0666 less the umask) instead of 0600
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        tmpname = '%s.%s' % (os.path.abspath(filename),
+                             os.urandom(6).encode('hex'))
+        try:
+            return (os.open(tmpname, flags, 0666), tmpname)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def _write_atomically(data, filename):
+    (fd, tmpname) = _mkstemp(filename)
+    try:
+        fp = os.fdopen(fd, 'wb')
+        try:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+        if os.path.exists(filename):
+            # the file keeps its mode
+            os.chmod(tmpname, os.stat(filename).st_mode & 07777)
+            if os.name == 'nt':
+                os.unlink(filename)
+        os.rename(tmpname, filename)
+    except:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+
+
+def save_storage(storage, filename, timeout=None):
+    """
+    saves storage atomically: the data is written to a temporary file in the
+    same folder that is renamed over filename, so the readers always see
+    either the old or the new content. The writers are serialized by an
+    exclusive lock on the file .storage.lock of the folder, held only while
+    the already serialized data is written, and waited for at most timeout
+    seconds. There is one such (empty) file for all the storage files of a
+    folder, it is left in place. A new file gets the mode 0666 less the
+    umask, an existing one keeps its mode.
+    """
+    data = dumps_storage(storage)
+    folder = os.path.dirname(os.path.abspath(filename))
+    lockfile = open(os.path.join(folder, STORAGE_LOCK), 'ab')
+    try:
+        lock = portalocker.locked(lockfile, portalocker.LOCK_EX, timeout)
+        lock.acquire()
+        try:
+            _write_atomically(data, filename)
+        finally:
+            lock.release()
+    finally:
+        lockfile.close()
 
 
 class Settings(Storage):
@@ -188,6 +511,11 @@ class Settings(Storage):
 
 
 class Messages(Storage):
+    """
+    like Settings, but the string values are translated by T when read.
+    The translations are memoized per language (T.accepted_language) and
+    per message, so a message is only translated once for each language.
+    """
 
     def __init__(self, T):
         self['T'] = T
@@ -203,5 +531,73 @@ class Messages(Storage):
     def __getattr__(self, key):
         value = self[key]
         if isinstance(value, str):
-            return str(self['T'](value))
+            T = self['T']
+            cache_key = (getattr(T, 'accepted_language', None), value)
+            translations = self.__dict__.setdefault('_translations', {})
+            if not cache_key in translations:
+                translations[cache_key] = str(T(value))
+            return translations[cache_key]
         return value
+
+
+def _legacy_load_storage(filename):
+    """ the pickle based load_storage, for the benchmark below """
+    fp = open(filename, 'rb')
+    portalocker.lock(fp, portalocker.LOCK_EX)
+    storage = cPickle.load(fp)
+    portalocker.unlock(fp)
+    fp.close()
+    return Storage(storage)
+
+
+def _benchmark_reader(args):
+    import time
+    (load, filename, loops) = args
+    t0 = time.time()
+    for i in xrange(loops):
+        load(filename)
+    return (time.time() - t0) / loops
+
+
+def _load_mmap(filename):
+    return load_storage(filename, mmap=True)
+
+
+if __name__ == '__main__':
+    # load latency of the pickle and of the marshal storage files, with
+    # several processes reading the same file at the same time
+    #     python storage.py [readers] [loads]
+    import sys
+    import shutil
+    import multiprocessing
+    readers = len(sys.argv) > 1 and int(sys.argv[1]) or 4
+    loops = len(sys.argv) > 2 and int(sys.argv[2]) or 200
+    settings = Storage(('key%s' % i, Storage(name=u'setting %s' % i, value=i,
+                        ratio=i / 3.0, tags=['a', 'b', str(i)],
+                        enabled=bool(i % 2))) for i in xrange(2000))
+    folder = tempfile.mkdtemp()
+    try:
+        legacy = os.path.join(folder, 'legacy.pickle')
+        fp = open(legacy, 'wb')
+        cPickle.dump(dict(settings), fp)
+        fp.close()
+        current = os.path.join(folder, 'settings.storage')
+        save_storage(settings, current)
+        assert load_storage(current) == settings
+        assert load_storage(current, mmap=True) == settings
+        assert load_storage(legacy, allow_pickle=True) == settings
+        pool = multiprocessing.Pool(readers)
+        print '%s readers, %s loads each, %s bytes pickle, %s bytes storage' \
+            % (readers, loops, os.path.getsize(legacy),
+               os.path.getsize(current))
+        for (name, load, filename) in [
+                ('pickle, exclusive lock', _legacy_load_storage, legacy),
+                ('storage, shared lock', load_storage, current),
+                ('storage, shared lock, mmap', _load_mmap, current)]:
+            times = pool.map(_benchmark_reader,
+                             [(load, filename, loops)] * readers)
+            print '%-28s %8.3f ms/load' % (name, 1000 * sum(times) / readers)
+        pool.close()
+        pool.join()
+    finally:
+        shutil.rmtree(folder)
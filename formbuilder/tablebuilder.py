@@ -32,8 +32,71 @@ import urllib
 import hashlib
 from hashfunc import web2py_uuid
 from storage import Storage
+from uploads import UploadStore, UploadError, upload_file
+
+def DEFAULT():
+    return 0
+DEFAULT_PASSWORD_DISPLAY = 8*('*')
+
+def safe_int(x):
+    try:
+        return int(x)
+    except ValueError:
+        return 0
+
+def safe_float(x):
+    try:
+        return float(x)
+    except ValueError:
+        return 0
+
+def identity(x):
+    return x
+
+def represent_list(values):
+    return ', '.join(str(v) for v in (values or []))
+
+callables = {}
+
+class RegisteredCallable(object):
+    """
+    picklable reference to a function registered with register_callable
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, *a, **b):
+        return callables[self.name](*a, **b)
+
+    def __repr__(self):
+        return '<RegisteredCallable %s>' % self.name
+
+def register_callable(name, function=None):
+    """
+    lambdas and nested functions cannot be pickled, so a Table using them
+    cannot be sent to other processes (see tableform.render_many).
+    Register them under a name and use the returned reference instead::
+
+        price = register_callable('price', lambda v: '%.2f $' % v)
+        Field('price', 'double', represent=price)
+
+    or as a decorator::
+
+        @register_callable('price')
+        def price(v):
+            return '%.2f $' % v
+
+    the registration must happen when the module defining the table is
+    imported, so the worker processes know the name too.
+    """
+    if function is None:
+        return lambda function: register_callable(name, function)
+    if name in callables and callables[name] is not function:
+        raise SyntaxError, 'callable already registered: %s' % name
+    callables[name] = function
+    return RegisteredCallable(name)
 
-DEFAULT = lambda:0
 class SQLCustomType(object):
     """
     allows defining of custom SQL types
@@ -72,8 +135,8 @@ class SQLCustomType(object):
 
         self.type = type
         self.native = native
-        self.encoder = encoder or (lambda x: x)
-        self.decoder = decoder or (lambda x: x)
+        self.encoder = encoder or identity
+        self.decoder = decoder or identity
         self.validator = validator
         self._class = _class or type
 
@@ -89,18 +152,91 @@ class SQLCustomType(object):
     def __str__(self):
         return self._class
 
+regex_cleanup = re.compile('[^0-9a-zA-Z_]')
+
 def cleanup(text):
     """
     validates that the given text is clean: only contains [0-9a-zA-Z_]
     """
 
-    if re.compile('[^0-9a-zA-Z_]').findall(text):
+    if regex_cleanup.search(text):
         raise SyntaxError, \
             'only [0-9a-zA-Z_] allowed in table and field names, received %s' \
             % text
     return text
 
-class Field(dict):
+class Freezable(object):
+    """
+    mixin for the dict based schema objects (Field, Table).
+
+    once frozen the object cannot be changed anymore, so a single module level
+    Table can be shared by all the threads of a server. All the per-request
+    state lives in the forms (FORMBUILDER) and in the vars/errors returned
+    by the validation, never in the schema.
+    """
+
+    _frozen = False
+
+    def freeze(self):
+        self.__dict__['_frozen'] = True
+        return self
+
+    def _check_frozen(self):
+        if self._frozen:
+            raise SyntaxError, '%s is frozen and cannot be changed' % self
+
+    def __delitem__(self, key):
+        self._check_frozen()
+        dict.__delitem__(self, key)
+
+    def update(self, *a, **b):
+        self._check_frozen()
+        dict.update(self, *a, **b)
+
+    def setdefault(self, key, default=None):
+        if not key in self:
+            self._check_frozen()
+        return dict.setdefault(self, key, default)
+
+    def pop(self, *a):
+        self._check_frozen()
+        return dict.pop(self, *a)
+
+    def popitem(self):
+        self._check_frozen()
+        return dict.popitem(self)
+
+    def clear(self):
+        self._check_frozen()
+        dict.clear(self)
+
+    # pickle support: the object is created empty, then the items are set
+    # (a field and its table refer to each other) and the attributes, like
+    # the frozen flag, are restored last. copy.deepcopy would restore the
+    # attributes first and then fail setting the items, see __deepcopy__
+    def __reduce_ex__(self, protocol):
+        return (copy_reg.__newobj__, (self.__class__,), self.__dict__,
+                None, self.iteritems())
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __deepcopy__(self, memo):
+        """
+        like copy.copy (see Field.__copy__) deep copies are never frozen
+        """
+        obj = self.__class__.__new__(self.__class__)
+        memo[id(self)] = obj
+        for (key, value) in self.iteritems():
+            dict.__setitem__(obj, copy.deepcopy(key, memo),
+                             copy.deepcopy(value, memo))
+        state = copy.deepcopy(self.__dict__, memo)
+        state.pop('_frozen', None)
+        obj.__dict__.update(state)
+        return obj
+
+
+class Field(Freezable, dict):
     def __init__(
         self,
         fieldname,
@@ -117,6 +253,8 @@ class Field(dict):
         represent=None,
         custom_store=None,
         custom_retrieve=None,
+        uploadfolder=None,
+        uploadqueue=None,
         ):
         self.db = None
         self.op = None
@@ -135,12 +273,18 @@ class Field(dict):
         self.writable = writable
         self.readable = readable
         self.update = update
-        if not represent and type in ('list:integer','list:string'):
-            represent=lambda x: ', '.join(str(y) for y in x or [])
+        if not represent and str(type).startswith('list:'):
+            represent = represent_list
         self.represent = represent
         self.isattachment = True
         self.custom_store = custom_store
         self.custom_retrieve = custom_retrieve
+        if isinstance(uploadfolder, basestring):
+            # stored without their extensions, an UploadStore with
+            # extensions=(...) keeps the allowed ones
+            uploadfolder = UploadStore(uploadfolder)
+        self.uploadfolder = uploadfolder
+        self.uploadqueue = uploadqueue
         if self.label == None:
             self.label = ' '.join([x.capitalize() for x in
                                   fieldname.split('_')])
@@ -150,8 +294,23 @@ class Field(dict):
             self.requires = requires
 
     def store(self, file, filename=None, path=None):
+        """
+        stores the upload file and returns its name, or, with an
+        uploadqueue, queues the store and returns a PendingUpload
+        """
+        if self.uploadqueue is not None:
+            if isinstance(file, basestring) and not file:
+                # nothing was uploaded
+                return file
+            return self.uploadqueue.submit(self._store, file, filename, path)
+        return self._store(file, filename, path)
+
+    def _store(self, file, filename=None, path=None):
         if callable(self.custom_store):
             return self.custom_store(file,filename,path)
+        elif self.uploadfolder:
+            prefix = '%s.%s' % (self.tablename or 'no_table', self.name)
+            return self.uploadfolder.store(file, filename or None, prefix, path)
         else:
             raise Exception("you must write your store yourself")
 
@@ -196,6 +355,11 @@ class Field(dict):
             return '<no table>.%s' % self.name
 
     def __setattr__(self, k, v):
+        self._check_frozen()
+        dict.__setitem__(self,k,v)
+
+    def __setitem__(self, k, v):
+        self._check_frozen()
         dict.__setitem__(self,k,v)
 
     def __getattr__(self, k):
@@ -204,6 +368,16 @@ class Field(dict):
         except KeyError:
             return None
 
+    def __copy__(self):
+        """
+        copies are never frozen, they can be customized and frozen again
+        """
+        field = self.__class__.__new__(self.__class__)
+        dict.update(field, self)
+        field.__dict__.update(self.__dict__)
+        field.__dict__.pop('_frozen', None)
+        return field
+
 def buildform(_table_name, *field):
     form = Storage()
     form._tablename = _table_name
@@ -278,13 +452,349 @@ def sqlhtml_validators(field):
         requires.append(validators.IS_TIME())
     elif field_type == 'datetime':
         requires.append(validators.IS_DATETIME())
-    elif field_type.startswith('list:'):
-        def repr_list(values): return', '.join(str(v) for v in (values or []))
-        field.represent = field.represent or repr_list
     return requires
 
 
-class Table(dict):
+def collapse_vars(table, request_vars):
+    """
+    returns a copy of request_vars where multiple values submitted for the
+    same name are reduced to the last one, unless the field is a list field
+    """
+    # the uploads (cgi.FieldStorage) are not copied, their open files
+    # cannot be deep copied
+    memo = {}
+    for value in request_vars.values():
+        for item in isinstance(value, (list, tuple)) and value or [value]:
+            if upload_file(item) is not None:
+                memo[id(item)] = item
+    request_vars = copy.deepcopy(request_vars, memo)
+    for itm in request_vars:
+        if isinstance(request_vars[itm],(list,tuple)):
+            if not (str(itm) in table.fields and str(table[itm].type).startswith("list::")):
+                request_vars[itm] = request_vars[itm][-1]
+    return request_vars
+
+
+def request_value(field, request_vars):
+    """
+    the value of field in the (collapsed) request_vars, as its widget
+    passes it to the validators
+    """
+    requires = field.requires
+    if field.type == 'boolean' or (hasattr(requires, 'options')
+                                   and requires.multiple):
+        # checkboxes
+        return request_vars.get(field.name)
+    return request_vars.get(field.name, '')
+
+
+def validate_vars(
+    table,
+    request_vars,
+    record=None,
+    fields=None,
+    ignore_rw=False,
+    upload=None,
+    ):
+    """
+    validates request_vars against the fields of table the same way
+    FORMBUILDER.accepts does (normalization of the request vars, validators,
+    booleans, uploads, passwords and type coercion) but without building
+    the html form. Usable from json apis and background workers::
+
+        (vars, errors) = validate_vars(db.table, request.vars)
+
+    :param record: the record being updated, if any
+    :param fields: the fields to validate, default is all readable or
+        writable fields
+    :param ignore_rw: validate also the fields which are not writable
+    :param upload: optional callable(field, request_vars) storing the
+        uploaded files, like the upload argument of FORMBUILDER.
+        Field.store is used otherwise
+    :returns: (vars, errors), two Storage objects
+    """
+    request_vars = collapse_vars(table, request_vars)
+    if fields == None:
+        fields = [f.name for f in table if (ignore_rw or f.writable or f.readable)]
+    vars = Storage()
+    errors = Storage()
+
+    for fieldname in fields:
+        if fieldname.find('.') >= 0 or not fieldname in table.fields:
+            continue
+        field = table[fieldname]
+        # readonly fields are only represented by FORMBUILDER, never validated
+        if field.type == 'blob' or (not ignore_rw and not field.writable):
+            continue
+        value = request_value(field, request_vars)
+        if str(field.type).startswith('list:') \
+                and not hasattr(field.requires, 'options') \
+                and not field.widget:
+            # the list widget does not validate its items
+            error = None
+        else:
+            (value, error) = field.validate(value)
+        vars[fieldname] = value
+        if error:
+            errors[fieldname] = error
+
+    if errors and record:
+        # an already uploaded file does not need to be uploaded again
+        for key in errors.keys():
+            if table[key].type == 'upload' \
+                    and request_vars.get(key,None) in (None,'') \
+                    and record.get(key) \
+                    and not key+'__delete' in request_vars:
+                del errors[key]
+    if errors:
+        return (vars, errors)
+
+    for fieldname in fields:
+        if not fieldname in table.fields:
+            continue
+        field = table[fieldname]
+        if not ignore_rw and not field.writable:
+            continue
+        if field.type in ('id', 'blob'):
+            continue
+        if field.type == 'boolean':
+            vars[fieldname] = vars.get(fieldname, False) and True or False
+            continue
+        elif field.type == 'password' and record \
+                and request_vars.get(fieldname, None) == DEFAULT_PASSWORD_DISPLAY:
+            # do not update if password was not changed
+            del vars[fieldname]
+            continue
+        elif field.type == 'upload':
+            if request_vars.get("%s__delete"%fieldname,False):
+                vars[fieldname] = ""
+            elif upload:
+                vars[fieldname] = upload(field, request_vars)
+            else:
+                try:
+                    vars[fieldname] = field.store(request_vars.get(fieldname,""),request_vars.get("%s.original"%fieldname,""))
+                except UploadError, e:
+                    errors[fieldname] = str(e)
+                    return (vars, errors)
+            continue
+        elif not fieldname in vars:
+            if field.default == None:
+                errors[fieldname] = 'no data'
+                return (vars, errors)
+            continue
+        value = vars[fieldname]
+        if field.type == 'list:string':
+            if not isinstance(value,(tuple,list)):
+                vars[fieldname] = value and [value] or []
+        elif field.type.startswith('list:'):
+            if not isinstance(value,list):
+                vars[fieldname] = [safe_int(x) for x in (value and [value] or [])]
+        elif field.type == 'integer':
+            if value != None:
+                vars[fieldname] = safe_int(value)
+        elif field.type == 'double':
+            if value != None:
+                vars[fieldname] = safe_float(value)
+    return (vars, errors)
+
+
+regex_bar = re.compile('(?<!\|)\|(?!\|)')
+CSV_TRUE = ('T', 'True', 'true', 'TRUE', '1', 'on')
+
+def csv_value(field, value):
+    """
+    the value of a csv cell for field: booleans and bar encoded lists
+    ('|a|b|') are decoded, the other values are left to the validators.
+    The items of the integer lists are left as strings, see import_rows
+    """
+    if value == '<NULL>':
+        return ''
+    type = str(field.type)
+    if type == 'boolean':
+        return value in CSV_TRUE
+    elif type == 'list:string':
+        if value.startswith('|') and value.endswith('|'):
+            value = value[1:-1]
+        return [x.replace('||', '|') for x in regex_bar.split(value)
+                if x.strip()]
+    elif type.startswith('list:'):
+        return [x.strip() for x in value.split('|') if x.strip()]
+    return value
+
+
+def import_rows(table, columns, rows):
+    """
+    validates rows, a list of (line, cells) read from a csv file, columns
+    maps the names of the fields to the index of their cell.
+    returns (records, errors) as described in :func:`import_csv`
+
+    the list fields are validated by their requires, and the items of the
+    integer lists must be integers::
+
+        >>> from validators import IS_IN_SET
+        >>> table = Table('t', Field('tags', 'list:string',
+        ...     requires=IS_IN_SET(['a', 'b'], multiple=True)),
+        ...     Field('ids', 'list:integer'))
+        >>> columns = [('tags', 0), ('ids', 1)]
+        >>> rows = [(2, ['|a|b|', '1|3']), (3, ['|a|zzz|', '1|x|3'])]
+        >>> (records, errors) = import_rows(table, columns, rows)
+        >>> (records[0].tags, records[0].ids)
+        (['a', 'b'], [1, 3])
+        >>> (errors[0][0], errors[0][2].ids)
+        (3, 'enter a list of integers')
+        >>> errors[0][2].tags is not None
+        True
+    """
+    records = []
+    errors = []
+    fields = [(table[name], index) for (name, index) in columns]
+    for (line, cells) in rows:
+        record = Storage()
+        record_errors = Storage()
+        for (field, index) in fields:
+            name = field.name
+            if index is None or index >= len(cells):
+                if field.default is not None:
+                    record[name] = field.default
+                    continue
+                # validated as empty, like a var missing from a form
+                cell = ''
+            else:
+                cell = cells[index]
+            value = csv_value(field, cell)
+            type = str(field.type)
+            if type == 'boolean' or type == 'upload':
+                # already decoded, or the name of a stored file
+                record[name] = value
+                continue
+            error = None
+            if field.requires:
+                (value, error) = field.validate(value)
+            elif value == '':
+                value = None
+            elif type == 'integer':
+                value = safe_int(value)
+            elif type == 'double':
+                value = safe_float(value)
+            if not error and type.startswith('list:') \
+                    and type != 'list:string':
+                try:
+                    value = [int(x) for x in value or []]
+                except (TypeError, ValueError):
+                    error = 'enter a list of integers'
+            if error:
+                record_errors[name] = error
+            record[name] = value
+        if record_errors:
+            errors.append((line, Storage((name, cells[index])
+                                         for (name, index) in columns
+                                         if index is not None
+                                         and index < len(cells)),
+                           record_errors))
+        else:
+            records.append(record)
+    return (records, errors)
+
+
+# state of the import_csv worker processes
+_import_schema = None
+
+def _init_import_worker(schema):
+    global _import_schema
+    _import_schema = cPickle.loads(schema)
+
+def _import_chunk(rows):
+    (table, columns) = _import_schema
+    return import_rows(table, columns, rows)
+
+
+def import_csv(table, file, chunksize=1000, fields=None, workers=None,
+               window=None, **csv_args):
+    """
+    reads the records of table from a csv file (the first row has the field
+    names, 'table.field' or 'field', like a web2py export) and validates
+    them with the validators of the fields. Yields, for every chunksize
+    rows, the tuple (records, errors)::
+
+        for (records, errors) in import_csv(db.person, open('people.csv')):
+            for record in records:
+                db.person.insert(**record)
+            for (line, row, error) in errors:
+                log.write('%s: %s %s\\n' % (line, row, error))
+
+    records are the valid rows, a list of Storage of the values returned by
+    the validators, errors are the invalid rows, a list of (line, row,
+    errors) where row has the csv cells and errors the messages of the
+    invalid fields.
+
+    :param fields: the fields to import, default is all but id. The ones
+        missing from the file (or from a short row) get their default, or,
+        without one, are validated as empty cells: a required field is an
+        error
+    :param workers: number of processes validating the chunks, None (or 1)
+        validates in the current process
+    :param window: number of chunks being validated at once by the workers,
+        default 2 * workers; at most window + 1 chunks are in memory
+    :param csv_args: arguments of csv.reader, like delimiter
+
+    booleans ('T', 'True', '1'...) and bar encoded lists ('|a|b|') are
+    decoded, '<NULL>' is an empty cell. The rows are read as they are
+    consumed, so the memory used does not depend on the size of the file.
+    With workers the table is pickled and sent to every worker, so its
+    validators must be picklable (see tableform.render_many).
+    """
+    reader = csv.reader(file, **csv_args)
+    try:
+        header = reader.next()
+    except StopIteration:
+        return
+    prefix = '%s.' % table._tablename
+    header = [name.strip() for name in header]
+    header = [name.startswith(prefix) and name[len(prefix):] or name
+              for name in header]
+    if fields is None:
+        fields = [field.name for field in table if field.type != 'id']
+    positions = {}
+    for (index, name) in enumerate(header):
+        positions.setdefault(name, index)
+    columns = [(name, positions.get(name)) for name in fields]
+
+    def chunks():
+        rows = []
+        for cells in reader:
+            if not cells:
+                continue
+            rows.append((reader.line_num, cells))
+            if len(rows) >= chunksize:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+
+    if not workers or workers < 2:
+        for rows in chunks():
+            yield import_rows(table, columns, rows)
+        return
+    import multiprocessing
+    schema = cPickle.dumps((table, columns), cPickle.HIGHEST_PROTOCOL)
+    pool = multiprocessing.Pool(workers, _init_import_worker, (schema,))
+    pending = []
+    try:
+        for rows in chunks():
+            pending.append(pool.apply_async(_import_chunk, (rows,)))
+            if len(pending) >= (window or 2 * workers):
+                yield pending.pop(0).get()
+        while pending:
+            yield pending.pop(0).get()
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    pool.join()
+
+
+class Table(Freezable, dict):
     def __init__(
         self,
         tablename,
@@ -317,6 +827,23 @@ class Table(dict):
                 field.requires = sqlhtml_validators(field)
         self.ALL = SQLALL(self)
 
+    def validate(self, request_vars, record=None, fields=None,
+                 ignore_rw=False, upload=None):
+        """
+        validates request_vars without building a form,
+        see :func:`validate_vars`
+        """
+        return validate_vars(self, request_vars, record, fields,
+                             ignore_rw, upload)
+
+    def import_csv(self, file, chunksize=1000, fields=None, workers=None,
+                   window=None, **csv_args):
+        """
+        yields the (records, errors) read from a csv file in chunks,
+        see :func:`import_csv`
+        """
+        return import_csv(self, file, chunksize, fields, workers, window,
+                          **csv_args)
 
     def __getitem__(self, key):
         if not key:
@@ -346,9 +873,21 @@ class Table(dict):
             if isinstance(key, dict):
                 raise SyntaxError,\
                     'value must be a dictionary: %s' % value
+            self._check_frozen()
             dict.__setitem__(self, str(key), value)
 
+    def freeze(self):
+        """
+        freezes the table and all its fields::
+
+            db.person = Table('person', Field('name')).freeze()
+        """
+        for field in self:
+            field.freeze()
+        return Freezable.freeze(self)
+
     def __delitem__(self, key):
+        self._check_frozen()
         if isinstance(key, dict):
             query = self._build_query(key)
             if not self._db(query).delete():
@@ -362,6 +901,7 @@ class Table(dict):
     def __setattr__(self, key, value):
         if key in self:
             raise SyntaxError, 'Object exists and cannot be redefined: %s' % key
+        self._check_frozen()
         dict.__setitem__(self,key,value)
 
     def __iter__(self):
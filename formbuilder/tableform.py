@@ -6,28 +6,21 @@ from html import FORM, INPUT, LABEL, OPTION, SELECT
 from html import TABLE, THEAD, TBODY, TR, TD, TH
 from storage import Storage
 from hashfunc import md5_hash
+from uploads import UploadError
 from validators import IS_EMPTY_OR
+from tablebuilder import safe_int, safe_float, collapse_vars
+from tablebuilder import DEFAULT_PASSWORD_DISPLAY
+import instrument
 import copy
 import urllib
 import re
 import cStringIO
+import cPickle
 
 
 table_field = re.compile('[\w_]+\.[\w_]+')
 widget_class = re.compile('^\w*')
 
-def safe_int(x):
-    try:
-        return int(x)
-    except ValueError:
-        return 0
-
-def safe_float(x):
-    try:
-        return float(x)
-    except ValueError:
-        return 0
-
 class FormWidget(object):
     """
     helper for FORMBUILDER to generate form input fields (widget),
@@ -373,7 +366,7 @@ class CheckboxesWidget(OptionsWidget):
 
 class PasswordWidget(FormWidget):
 
-    DEFAULT_PASSWORD_DISPLAY = 8*('*')
+    DEFAULT_PASSWORD_DISPLAY = DEFAULT_PASSWORD_DISPLAY
 
     @staticmethod
     def widget(field, value, **attributes):
@@ -523,6 +516,50 @@ class FORMBUILDER(FORM):
     any named optional attribute is passed to the <form> tag
             for example _class, _id, _style, _action, _method, etc.
 
+    a frozen table can be shared by all the threads, each request building
+    its own form (or reusing one with reset), every thread gets what a
+    single thread gets::
+
+        >>> import threading, tablebuilder, validators
+        >>> Field = tablebuilder.Field
+        >>> table = tablebuilder.Table('person',
+        ...     Field('name', default='hello', requires=validators.IS_NOT_EMPTY()),
+        ...     Field('age', 'integer', requires=validators.IS_INT_IN_RANGE(18, 25)),
+        ...     Field('email', requires=validators.IS_EMAIL()),
+        ...     Field('subscribed', 'boolean', default=False),
+        ...     Field('photo', 'upload', custom_store=lambda f, n, p: 'up/' + f),
+        ...     Field('tags', 'list:string'),
+        ...     Field('friends', 'list::string', default=['tim'],
+        ...           requires=validators.IS_IN_SET(['tim', 'jim'], multiple=True)),
+        ...     ).freeze()
+        >>> requests = [
+        ...     dict(name='tim', age='20', email='a@b.com', subscribed='on',
+        ...          friends=['tim', 'jim'], photo='a.jpg', tags='x'),
+        ...     dict(name='', age='40', email='bad', friends=['bob'], tags=['a', 'b']),
+        ...     dict(name='jim', age='19', email='jim@example.com', friends='jim')]
+        >>> def run(vars, record=None, form=None):
+        ...     form = form and form.reset(record) or FORMBUILDER(table, record)
+        ...     render = form.xml()
+        ...     accepted = form.accepts(vars)
+        ...     return (render, accepted, sorted(form.vars.items()),
+        ...             sorted(form.errors.items()), form.xml(),
+        ...             table.validate(vars, record))
+        >>> expected = [(run(vars), run(vars, vars)) for vars in requests]
+        >>> failures = []
+        >>> def worker():
+        ...     form = FORMBUILDER(table)
+        ...     for i in xrange(60):
+        ...         k = i % len(requests)
+        ...         record = i % 2 and requests[k] or None
+        ...         if run(requests[k], record, i % 4 > 1 and form) != \\
+        ...                 expected[k][i % 2]:
+        ...             failures.append(i)
+        >>> snapshot = [dict(field) for field in table]
+        >>> threads = [threading.Thread(target=worker) for i in xrange(8)]
+        >>> for thread in threads: thread.start()
+        >>> for thread in threads: thread.join()
+        >>> failures, [dict(field) for field in table] == snapshot
+        ([], True)
     """
 
     # usability improvements proposal by fpp - 4 May 2008 :
@@ -556,6 +593,7 @@ class FORMBUILDER(FORM):
     FIELDKEY_DELETE_RECORD = 'delete_record'
     ID_LABEL_SUFFIX = '__label'
     ID_ROW_SUFFIX = '__row'
+    NBSP = XML('&nbsp;') # Firefox2 does not display fields with blanks
 
     def __init__(
         self,
@@ -585,17 +623,18 @@ class FORMBUILDER(FORM):
                fields=['name'],
                labels={'name': 'Your name'},
         """
+        sink = instrument.sink
+        if sink is not None:
+            t0 = instrument.timer()
         self.table = table
-        if record:
-            for itm in record:
-                if isinstance(record[itm],(list,tuple)):
-                    if not (itm in self.table.fields and self.table[itm].type.startswith("list::")):
-                        record[itm] = record[itm][-1]
+        self._collapse_record(record)
         self.custom_file = upload
         self.ignore_rw = ignore_rw
+        self.readonly = readonly
+        self.download = download
+        self.keepopts = keepopts
         self.formstyle = formstyle
         self.record_pk_name = record_pk_name
-        nbsp = XML('&nbsp;') # Firefox2 does not display fields with blanks
         attributes.update({"_id":"hyform_%s"%self.table._tablename})
         FORM.__init__(self, *[], **attributes)
         ofields = fields
@@ -654,69 +693,19 @@ class FORMBUILDER(FORM):
             else:
                 default = field.default
 
-            cond = readonly or \
-                (not ignore_rw and not field.writable and field.readable)
-
-            if default and not cond:
-                default = field.formatter(default)
-            dspval = default
-            inpval = default
-
-            if cond:
-
-                # ## if field.represent is available else
-                # ## ignore blob and preview uploaded images
-                # ## format everything else
-
-                if field.represent:
-                    inp = field.represent(default)
-                elif field.type in ['blob']:
-                    continue
-                elif field.type == 'upload':
-                    inp = UploadWidget.represent(field, default, download)
-                elif field.type == 'boolean':
-                    inp = self.widgets.boolean.widget(field, default, _disabled=True)
-                else:
-                    inp = field.formatter(default)
-            elif field.type == 'upload':
-                if hasattr(field, 'widget') and field.widget:
-                    inp = field.widget(field, default, download)
-                else:
-                    inp = self.widgets.upload.widget(field, default, download)
-            elif hasattr(field, 'widget') and field.widget:
-                inp = field.widget(field, default)
-            elif field.type == 'boolean':
-                inp = self.widgets.boolean.widget(field, default)
-                if default:
-                    inpval = 'checked'
-                else:
-                    inpval = ''
-            elif OptionsWidget.has_options(field):
-                if not field.requires.multiple:
-                    inp = self.widgets.options.widget(field, default)
-                else:
-                    inp = self.widgets.multiple.widget(field, default)
-                if fieldname in keepopts:
-                    inpval = TAG[''](*inp.components)
-            elif field.type.startswith('list:'):
-                inp = self.widgets.list.widget(field,default)
-            elif field.type == 'text':
-                inp = self.widgets.text.widget(field, default)
-            elif field.type == 'hidden':
-                inp = self.widgets.hidden.widget(field, default)
-            elif field.type == 'password':
-                inp = self.widgets.password.widget(field, default)
-                if self.record:
-                    dspval = PasswordWidget.DEFAULT_PASSWORD_DISPLAY
-                else:
-                    dspval = ''
-            elif field.type == 'blob':
-                continue
+            if sink is None:
+                built = self._build_widget(field, default)
             else:
-                inp = self.widgets.string.widget(field, default)
+                t1 = instrument.timer()
+                built = self._build_widget(field, default)
+                sink.timing('formbuilder.widget', instrument.timer() - t1,
+                            table=table._tablename, field=fieldname)
+            if built is None:
+                continue
+            (inp, dspval, inpval) = built
             xfields_keys.append(fieldname)
             xfields[fieldname] = (row_id,label,inp,comment)
-            self.custom.dspval[fieldname] = dspval or nbsp
+            self.custom.dspval[fieldname] = dspval or FORMBUILDER.NBSP
             self.custom.inpval[fieldname] = inpval or ''
             self.custom.widget[fieldname] = inp
 
@@ -734,9 +723,7 @@ class FORMBUILDER(FORM):
             if not self['hidden']:
                 self['hidden'] = {}
 
-        (begin, end) = self._xml()
-        self.custom.begin = XML("<%s %s>" % (self.tag, begin))
-        self.custom.end = XML("%s</%s>" % (end, self.tag))
+        self._build_custom_tags()
 
         table = TAG['']()
         if formstyle == 'divs':
@@ -776,6 +763,150 @@ class FORMBUILDER(FORM):
                                  DIV(c,_class='w2p_fc'),_id=id,_class="fb_row"))
 
         self.components = [table, self.custom.submit]
+        if sink is not None:
+            sink.timing('formbuilder.init', instrument.timer() - t0,
+                        table=self.table._tablename)
+
+    def _collapse_record(self, record):
+        if record:
+            for itm in record:
+                if isinstance(record[itm],(list,tuple)):
+                    if not (itm in self.table.fields and self.table[itm].type.startswith("list::")):
+                        record[itm] = record[itm][-1]
+
+    def _build_widget(self, field, default):
+        """
+        builds the widget of a field, or its representation when the field
+        is readonly.
+
+        :returns: (widget, dspval, inpval) or None if the field is not shown
+        """
+        cond = self.readonly or \
+            (not self.ignore_rw and not field.writable and field.readable)
+
+        if default and not cond:
+            default = field.formatter(default)
+        dspval = default
+        inpval = default
+
+        if cond:
+
+            # ## if field.represent is available else
+            # ## ignore blob and preview uploaded images
+            # ## format everything else
+
+            if field.represent:
+                inp = field.represent(default)
+            elif field.type in ['blob']:
+                return None
+            elif field.type == 'upload':
+                inp = UploadWidget.represent(field, default, self.download)
+            elif field.type == 'boolean':
+                inp = self.widgets.boolean.widget(field, default, _disabled=True)
+            else:
+                inp = field.formatter(default)
+        elif field.type == 'upload':
+            if hasattr(field, 'widget') and field.widget:
+                inp = field.widget(field, default, self.download)
+            else:
+                inp = self.widgets.upload.widget(field, default, self.download)
+        elif hasattr(field, 'widget') and field.widget:
+            inp = field.widget(field, default)
+        elif field.type == 'boolean':
+            inp = self.widgets.boolean.widget(field, default)
+            if default:
+                inpval = 'checked'
+            else:
+                inpval = ''
+        elif OptionsWidget.has_options(field):
+            if not field.requires.multiple:
+                inp = self.widgets.options.widget(field, default)
+            else:
+                inp = self.widgets.multiple.widget(field, default)
+            if field.name in self.keepopts:
+                inpval = TAG[''](*inp.components)
+        elif field.type.startswith('list:'):
+            inp = self.widgets.list.widget(field,default)
+        elif field.type == 'text':
+            inp = self.widgets.text.widget(field, default)
+        elif field.type == 'hidden':
+            inp = self.widgets.hidden.widget(field, default)
+        elif field.type == 'password':
+            inp = self.widgets.password.widget(field, default)
+            if self.record:
+                dspval = PasswordWidget.DEFAULT_PASSWORD_DISPLAY
+            else:
+                dspval = ''
+        elif field.type == 'blob':
+            return None
+        else:
+            inp = self.widgets.string.widget(field, default)
+        return (inp, dspval, inpval)
+
+    def reset(self, record=None):
+        """
+        brings an already built form back to the state it had right after
+        being built for record (None for an insert form), so the same
+        instance can be reused for another request instead of building a new
+        one::
+
+            form = FORMBUILDER(db.table)
+            if form.accepts(request.vars): ...
+            form.reset()
+            if form.accepts(other_request.vars): ...
+
+        vars, errors, latest and the per-request attributes set by accepts
+        are cleared and the widgets are rebuilt with their default values.
+        The rows, labels and comments of the form are kept.
+
+        A form must not be used by two threads at the same time, keep one
+        form per thread (or a pool of forms) instead.
+        """
+        self.vars.clear()
+        self.errors.clear()
+        self.latest.clear()
+        for name in ('request_vars', 'formname', 'keepvalues', 'record_id'):
+            self.__dict__.pop(name, None)
+        # _traverse hands the request vars down to every component,
+        # do not keep them alive until the next request
+        stack = list(self.components)
+        while stack:
+            c = stack.pop()
+            if isinstance(c, DIV):
+                c.__dict__.pop('request_vars', None)
+                stack.extend(c.components)
+        self._collapse_record(record)
+        self.record = record
+        if record and not self['hidden']:
+            self['hidden'] = {}
+
+        for fieldname in self.custom.widget.keys():
+            field = self.table[fieldname]
+            if record:
+                default = record.get(fieldname, field.default)
+            else:
+                default = field.default
+            (inp, dspval, inpval) = self._build_widget(field, default)
+            row_id = '%s_%s%s' % (self.table._tablename, fieldname,
+                                  FORMBUILDER.ID_ROW_SUFFIX)
+            if row_id in self.field_parent:
+                parent = self.field_parent[row_id]
+                parent.components = [inp]
+                parent._setnode(inp)
+            self.custom.dspval[fieldname] = dspval or FORMBUILDER.NBSP
+            self.custom.inpval[fieldname] = inpval or ''
+            self.custom.widget[fieldname] = inp
+        self._build_custom_tags()
+        return self
+
+    def _build_custom_tags(self):
+        """
+        custom.begin and custom.end, the opening and the closing tag of the
+        form for the custom rendered forms, from the current attributes
+        """
+        (begin, end) = DIV(**self.attributes)._xml()
+        self.custom.begin = XML("<%s %s>" % (self.tag, begin))
+        self.custom.end = self._custom_end = XML("</%s>" % self.tag)
 
     def accepts(
         self,
@@ -784,6 +915,7 @@ class FORMBUILDER(FORM):
         keepvalues=False,
         onvalidation=None,
         hideerror=False,
+        executor=None,
         ):
 
         """
@@ -793,15 +925,26 @@ class FORMBUILDER(FORM):
           form.record_changed = True (record cannot be submitted because changed)
         elseif detect_record_change == False than:
           form.record_changed = None
+        executor runs the io_bound validators, see FORM.accepts.
         """
+        sink = instrument.sink
+        if sink is None:
+            return self._accepts(request_vars, formname, keepvalues,
+                                 onvalidation, hideerror, executor)
+        t0 = instrument.timer()
+        try:
+            return self._accepts(request_vars, formname, keepvalues,
+                                 onvalidation, hideerror, executor)
+        finally:
+            sink.timing('formbuilder.accepts', instrument.timer() - t0,
+                        table=self.table._tablename)
+
+    def _accepts(self, request_vars, formname, keepvalues, onvalidation,
+                 hideerror, executor):
         # implement logic to detect whether record exist but has been modified
         # server side
         _vars_ = {}
-        request_vars = copy.deepcopy(request_vars)
-        for itm in request_vars:
-            if isinstance(request_vars[itm],(list,tuple)):
-                if not (str(itm) in self.table.fields and str(self.table[itm].type).startswith("list::")):
-                    request_vars[itm] = request_vars[itm][-1]
+        request_vars = collapse_vars(self.table, request_vars)
         if self.record:
             (formname_id, record_id) = ( self.record.get(self.record_pk_name, None), 
                                          request_vars.get(self.record_pk_name, None))
@@ -834,6 +977,7 @@ class FORMBUILDER(FORM):
             keepvalues,
             onvalidation,
             hideerror=hideerror,
+            executor=executor,
             )
 
         if not ret and self.record and self.errors:
@@ -863,13 +1007,18 @@ class FORMBUILDER(FORM):
         # that does not pass validation, yet it should be deleted
 
         if not ret and not auch:
+            sink = instrument.sink
+            if sink is not None:
+                t0 = instrument.timer()
             for fieldname in self.fields:
                 field = self.table[fieldname]
                 ### this is a workaround! widgets should always have default not None!
-                if not field.widget and field.type.startswith('list:') and \
+                ### (the table may be shared by other requests, do not store it)
+                widget_builder = field.widget
+                if not widget_builder and field.type.startswith('list:') and \
                         not OptionsWidget.has_options(field):
-                    field.widget = self.widgets.list.widget
-                if hasattr(field, 'widget') and field.widget and fieldname in request_vars:
+                    widget_builder = self.widgets.list.widget
+                if widget_builder and fieldname in request_vars:
                     if fieldname in self.vars:
                         value = self.vars[fieldname]
                     elif self.record:
@@ -877,11 +1026,14 @@ class FORMBUILDER(FORM):
                     else:
                         value = self.table[fieldname].default
                     row_id = '%s_%s%s' % (self.table,fieldname,FORMBUILDER.ID_ROW_SUFFIX)
-                    widget = field.widget(field, value)
+                    widget = widget_builder(field, value)
                     self.field_parent[row_id].components = [ widget ]
                     if not field.type.startswith('list:'):
                         self.field_parent[row_id]._traverse(False,hideerror)
                     self.custom.widget[ fieldname ] = widget
+            if sink is not None:
+                sink.timing('formbuilder.rerender', instrument.timer() - t0,
+                            table=self.table._tablename)
             return ret
         self.record_id = record_id
 
@@ -922,7 +1074,11 @@ class FORMBUILDER(FORM):
                 if self.custom_file:
                     self.vars[fieldname] = self.custom_file(field, request_vars)
                 else:
-                    self.vars[fieldname] = field.store(request_vars.get(fieldname,""),request_vars.get("%s.original"%fieldname,""))
+                    try:
+                        self.vars[fieldname] = field.store(request_vars.get(fieldname,""),request_vars.get("%s.original"%fieldname,""))
+                    except UploadError, e:
+                        self.errors[fieldname] = str(e)
+                        return False
                 continue
             elif fieldname in self.vars:
                 fields[fieldname] = self.vars[fieldname]
@@ -950,6 +1106,55 @@ class FORMBUILDER(FORM):
                 fields[fieldname] = self.vars[fieldname]
         return ret
 
+# state of the render_many worker processes
+_render_table = None
+_render_attributes = None
+
+def _init_render_worker(schema):
+    global _render_table, _render_attributes
+    (_render_table, _render_attributes) = cPickle.loads(schema)
+
+def _render_record(record):
+    return str(FORMBUILDER(_render_table, record, **_render_attributes))
+
+def render_many(table, records, workers=None, chunksize=16,
+                readonly=True, **attributes):
+    """
+    renders a FORMBUILDER for each record and yields the html strings in
+    the same order as records::
+
+        for html in render_many(db.table, records, workers=4):
+            archive.write(html)
+
+    :param workers: number of processes rendering the forms, None (or 1)
+        renders in the current process
+    :param chunksize: number of records sent to a worker at once
+    :param readonly: forms are readonly views by default
+    :param attributes: any other FORMBUILDER argument
+
+    the table and the attributes are pickled once and sent to every worker,
+    so the validators, represent and widget functions must be picklable:
+    module level functions or callables registered with
+    tablebuilder.register_callable, not lambdas.
+    """
+    attributes['readonly'] = readonly
+    if not workers or workers < 2:
+        for record in records:
+            yield str(FORMBUILDER(table, record, **attributes))
+        return
+    import multiprocessing
+    schema = cPickle.dumps((table, attributes), cPickle.HIGHEST_PROTOCOL)
+    pool = multiprocessing.Pool(workers, _init_render_worker, (schema,))
+    try:
+        for html in pool.imap(_render_record, records, chunksize):
+            yield html
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    pool.join()
+
 if __name__ == '__main__':
     import tablebuilder
     frm = tablebuilder.Table(
@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Reading uploaded files without copying them in memory.
+
+cgi.FieldStorage (and tempfile.SpooledTemporaryFile) keep the small
+uploads in memory and write the large ones to a temporary file. For the
+files on disk mapped gives a read only mmap of the content, so the
+validators can look at the headers and the size of a multi-megabyte
+upload without reading it into a string::
+
+    view = mapped(request.vars.image.file)
+    try:
+        data = view.open()
+        is_png = data[:8] == '\\211PNG\\r\\n\\032\\n'
+    finally:
+        view.close()
+
+or, from python 2.6, with mapped(file) as data: ...
+
+upload_size(value) is the size in bytes of an upload, also without
+reading it.
+
+UploadStore saves the uploads to a folder, copying them in chunks while
+hashing them and checking their size, see Field(uploadfolder=...).
+
+UploadQueue stores the uploads on worker threads, so accepts does not wait
+for the slow stores (thumbnails, virus scans...), see
+Field(uploadqueue=...).
+"""
+
+import os
+import re
+import logging
+import stat
+import mmap
+import tempfile
+import threading
+import Queue
+from storage import Storage
+from hashfunc import new_digest, web2py_uuid
+
+def _fileno(file):
+    """ the file descriptor of a regular file, None for the in memory ones """
+    if getattr(file, '_rolled', True) is False:
+        # a SpooledTemporaryFile still in memory, fileno() would write it
+        return None
+    try:
+        fileno = file.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
+    if not stat.S_ISREG(os.fstat(fileno).st_mode):
+        return None
+    try:
+        # the writes still in the buffer of the file are not in the mmap
+        file.flush()
+    except (AttributeError, IOError):
+        pass
+    return fileno
+
+
+def _getvalue(file):
+    """ the content of an in memory file, without moving its position """
+    if getattr(file, '_rolled', True) is False:
+        file = file._file
+    if hasattr(file, 'getvalue'):
+        return file.getvalue()
+    position = file.tell()
+    file.seek(0)
+    try:
+        return file.read()
+    finally:
+        file.seek(position)
+
+
+def upload_file(value):
+    """ the file of an upload: value.file for cgi.FieldStorage, else value """
+    file = getattr(value, 'file', None)
+    if file is None and hasattr(value, 'read'):
+        return value
+    return file
+
+
+def upload_size(value):
+    """
+    the size in bytes of an upload (a cgi.FieldStorage or a file), taken
+    from the file system or from the in memory data, without reading it
+    """
+    file = upload_file(value)
+    if file is None:
+        return len(getattr(value, 'value', None) or '')
+    fileno = _fileno(file)
+    if fileno is not None:
+        return os.fstat(fileno).st_size
+    if getattr(file, '_rolled', True) is False:
+        file = file._file
+    position = file.tell()
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(position)
+    return size
+
+
+class mapped(object):
+    """
+    the content of a file as a read only buffer: open() returns an mmap
+    (sliceable like a string, only the slices are copied) for the files on
+    disk and the string of the in memory ones. close() releases the mmap.
+    The position of the file does not change.
+    """
+
+    def __init__(self, file):
+        self.file = upload_file(file)
+        self.map = None
+
+    def open(self):
+        fileno = _fileno(self.file)
+        if fileno is None:
+            return _getvalue(self.file)
+        if not os.fstat(fileno).st_size:
+            # an empty file cannot be mapped
+            return ''
+        self.map = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_chunks(file, chunk_size=3 * 2 ** 16):
+    """
+    yields the content of file in chunks of chunk_size bytes, slicing the
+    mapped file, so at most one chunk is copied at a time
+    """
+    view = mapped(file)
+    try:
+        data = view.open()
+        for i in xrange(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+    finally:
+        view.close()
+
+
+class UploadError(Exception):
+    """ an upload that cannot be stored, the message is for the user """
+
+
+regex_extension = re.compile('^[a-z0-9]{1,16}$')
+
+class UploadStore(object):
+    """
+    stores the uploaded files in folder::
+
+        store = UploadStore('uploads', max_size=10 * 2 ** 20, dedupe=True)
+        name = store.store(request.vars.image)
+        fp = store.open(name)
+
+    the upload (a cgi.FieldStorage, a file or a string) is copied
+    chunk_size bytes at a time to a temporary file of folder, hashed with
+    digest_alg while being copied, and renamed when complete, so a stored
+    file is never partial. An upload bigger than max_size bytes raises
+    UploadError, as soon as its size is known or the copy goes beyond it.
+
+    the name is prefix.uuid.extension, or, with dedupe, digest.extension:
+    the identical uploads are then stored once and share the name.
+
+    the extension comes from the filename sent by the client. If folder is
+    served by the web server a file stored as .html, .svg, .js, .php... can
+    be rendered or executed by it, so by default the files are stored
+    without an extension. extensions is the allow-list of the ones kept,
+    e.g. extensions=('jpg', 'png', 'pdf') (the image preview of the upload
+    widget needs the extension of the images)::
+
+        >>> UploadStore('uploads').extension('photo.jpg')
+        ''
+        >>> store = UploadStore('uploads', extensions=('jpg', '.png'))
+        >>> (store.extension('../photo.JPG'), store.extension('x.php'))
+        ('jpg', '')
+    """
+
+    def __init__(self, folder, max_size=None, dedupe=False,
+                 digest_alg='sha256', chunk_size=2 ** 16,
+                 error_message='file too big (max %(max)s bytes)',
+                 extensions=()):
+        self.folder = folder
+        self.max_size = max_size
+        self.dedupe = dedupe
+        self.digest_alg = digest_alg
+        self.chunk_size = chunk_size
+        self.error_message = error_message
+        self.extensions = frozenset(e.lower().lstrip('.') for e in extensions)
+
+    def extension(self, filename):
+        """ the extension of filename, when it is one of extensions, or '' """
+        extension = os.path.basename(filename or '').rsplit('.', 1)[1:]
+        extension = extension and extension[0].lower() or ''
+        if extension in self.extensions and regex_extension.match(extension):
+            return extension
+        return ''
+
+    def save(self, value, filename=None, prefix=None, path=None):
+        """
+        stores the upload value and returns a Storage with its name, size,
+        digest (hexadecimal) and duplicate (True if the same content was
+        already stored, with dedupe)
+        """
+        folder = path or self.folder
+        if isinstance(value, basestring):
+            (file, data) = (None, value)
+        else:
+            (file, data) = (upload_file(value), None)
+            filename = filename or getattr(value, 'filename', None)
+        max_size = self.max_size
+        if max_size is not None:
+            if data is not None:
+                size = len(data)
+            else:
+                try:
+                    size = upload_size(file)
+                except (AttributeError, IOError, OSError):
+                    # a stream, checked while copying
+                    size = 0
+            if size > max_size:
+                raise UploadError, self.error_message % dict(max=max_size)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+        digest = new_digest(self.digest_alg)
+        (fd, temp) = tempfile.mkstemp(prefix='.upload-', dir=folder)
+        try:
+            out = os.fdopen(fd, 'wb')
+            try:
+                size = 0
+                if data is not None:
+                    chunks = [data]
+                else:
+                    try:
+                        file.seek(0)
+                    except (AttributeError, IOError):
+                        pass
+                    chunks = iter(lambda: file.read(self.chunk_size), '')
+                for chunk in chunks:
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise UploadError, \
+                            self.error_message % dict(max=max_size)
+                    digest.update(chunk)
+                    out.write(chunk)
+            finally:
+                out.close()
+            extension = self.extension(filename)
+            hexdigest = digest.hexdigest()
+            duplicate = False
+            if self.dedupe:
+                name = hexdigest
+            else:
+                name = web2py_uuid().replace('-', '')
+                if prefix:
+                    name = '%s.%s' % (prefix, name)
+            if extension:
+                name = '%s.%s' % (name, extension)
+            destination = os.path.join(folder, name)
+            if self.dedupe and os.path.exists(destination):
+                duplicate = True
+                os.unlink(temp)
+            else:
+                os.rename(temp, destination)
+        except:
+            if os.path.exists(temp):
+                os.unlink(temp)
+            raise
+        return Storage(name=name, size=size, digest=hexdigest,
+                       duplicate=duplicate)
+
+    def store(self, value, filename=None, prefix=None, path=None):
+        """ stores the upload value and returns its name """
+        if isinstance(value, basestring) and not value \
+                or getattr(value, 'filename', None) == '':
+            # nothing was uploaded
+            return ''
+        return self.save(value, filename, prefix, path).name
+
+    def open(self, name, path=None):
+        """ the stored file name, open for reading """
+        if os.path.basename(name) != name or name.startswith('.'):
+            raise UploadError, 'invalid file name'
+        return open(os.path.join(path or self.folder, name), 'rb')
+
+
+class PendingUpload(object):
+    """
+    an upload stored in the background by an UploadQueue: done() tells if
+    the store finished, result() waits for it and returns the stored name
+    (or raises the exception of the store) and add_callback(callback)
+    calls callback(pending) when it finishes, on the worker thread (or now
+    if it already finished)::
+
+        form.vars.image.add_callback(lambda pending: notify(pending.result()))
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.callbacks = []
+        self.name = None
+        self.error = None
+
+    def done(self):
+        return self.event.isSet()
+
+    def wait(self, timeout=None):
+        """ waits for the store, returns False if it did not finish yet """
+        self.event.wait(timeout)
+        return self.event.isSet()
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise UploadError, 'upload not stored yet'
+        if self.error is not None:
+            raise self.error
+        return self.name
+
+    def add_callback(self, callback):
+        self.lock.acquire()
+        try:
+            if not self.event.isSet():
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.lock.release()
+        callback(self)
+
+    def run(self, function, args, kwargs):
+        try:
+            self.name = function(*args, **kwargs)
+        except Exception, e:
+            self.error = e
+        self.lock.acquire()
+        try:
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        finally:
+            self.lock.release()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logging.getLogger('formbuilder').exception(
+                    'upload callback failed')
+
+    def __repr__(self):
+        if not self.done():
+            return '<PendingUpload>'
+        return '<PendingUpload %r>' % (self.error or self.name)
+
+
+class UploadQueue(object):
+    """
+    runs the stores of the uploads on workers threads::
+
+        uploads = UploadQueue(workers=2, maxsize=20)
+        db.define_table('doc', Field('image', 'upload',
+                                     custom_store=make_thumbnails,
+                                     uploadqueue=uploads))
+        if form.accepts(request.vars):
+            form.vars.image.add_callback(image_stored)
+
+    accepts then puts the store in the queue and the var of the field is a
+    PendingUpload. The queue holds at most maxsize uploads: when it is full
+    submit waits up to timeout seconds (None waits forever) for a worker to
+    take one, then raises UploadError, which accepts shows as an error of
+    the field. The upload (the file of the cgi.FieldStorage) is kept open
+    until it is stored.
+
+    with synchronous=True (for tests) the stores run at once in submit.
+    close() waits for the queued stores and stops the workers.
+    """
+
+    def __init__(self, workers=2, maxsize=100, timeout=10, synchronous=False,
+                 error_message='too many uploads, try again later'):
+        self.workers = workers
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self.error_message = error_message
+        self.queue = Queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.threads = []
+        self.closed = False
+
+    def start(self):
+        """ starts the workers, submit starts them if needed """
+        self.lock.acquire()
+        try:
+            if self.closed:
+                raise UploadError, 'upload queue closed'
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work,
+                                          name='formbuilder-upload')
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                (pending, function, args, kwargs) = item
+                pending.run(function, args, kwargs)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, function, *args, **kwargs):
+        """ queues function(*args, **kwargs) and returns its PendingUpload """
+        pending = PendingUpload()
+        if self.synchronous:
+            pending.run(function, args, kwargs)
+            return pending
+        if len(self.threads) < self.workers or self.closed:
+            self.start()
+        try:
+            if self.timeout == 0:
+                self.queue.put_nowait((pending, function, args, kwargs))
+            else:
+                self.queue.put((pending, function, args, kwargs), True,
+                               self.timeout)
+        except Queue.Full:
+            raise UploadError, self.error_message
+        return pending
+
+    def join(self):
+        """ waits for the queued stores """
+        self.queue.join()
+
+    def close(self):
+        """ waits for the queued stores and stops the workers """
+        self.lock.acquire()
+        try:
+            self.closed = True
+            threads = self.threads
+            self.threads = []
+        finally:
+            self.lock.release()
+        for thread in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
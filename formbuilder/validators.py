@@ -11,6 +11,7 @@ Thanks to ga2arch for help with IS_IN_DB and IS_NOT_IN_DB on GAE
 
 import os
 import re
+import array
 import datetime
 import time
 import cgi
@@ -18,11 +19,21 @@ import hmac
 import urllib
 import struct
 import decimal
+import threading
 import unicodedata
 from cStringIO import StringIO
-from hashfunc import hash,md5_hash
+from hashfunc import hash,md5_hash,get_digest,new_digest,update_digest
+from hashfunc import pbkdf2_hex,compare
+from storage import LRUCache
+from uploads import mapped, upload_size
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __all__ = [
+    'ADAPTIVE',
     'CLEANUP',
     'CRYPT',
     'IS_ALPHANUMERIC',
@@ -56,6 +67,7 @@ __all__ = [
     'IS_UPLOAD_FILENAME',
     'IS_UPPER',
     'IS_URL',
+    'MEMOIZE',
     'IS_LESS_THAN',
     'IS_GREATER_THAN'
     ]
@@ -101,6 +113,20 @@ class Validator(object):
     Notice that default error messages are not translated.
     """
 
+    # validators spending most of their time waiting (database queries,
+    # reading files) set io_bound = True: accepts(executor=...) runs them
+    # on the executor, a pool of threads, concurrently with the other fields
+    io_bound = False
+
+    # validators that never change the value and do not depend on the
+    # other validators set reorderable = True: ADAPTIVE can run them in
+    # any order
+    reorderable = False
+
+    # validators whose result only depends on the value set cacheable = True:
+    # MEMOIZE can cache their results
+    cacheable = False
+
     def formatter(self, value):
         """
         For some validators returns a formatted version (matching the validator)
@@ -109,6 +135,66 @@ class Validator(object):
         return value
 
 
+class Completed(object):
+    """
+    the result of a validator that is already known, with the interface of
+    a future
+    """
+
+    def __init__(self, result):
+        self._result = result
+
+    def result(self, timeout=None):
+        return self._result
+
+    get = result
+
+
+def call_async(validator, value, pool=None):
+    """
+    implements validator.__acall__(value) for FORM.accepts_async: the
+    validator runs on pool (a multiprocessing.pool.ThreadPool, a process
+    pool cannot receive the database of the validator) and the AsyncResult
+    is returned; without a pool it runs now.
+
+    the validator runs in another thread, so the database it queries must
+    be usable from the threads of the pool.
+    """
+    if pool is None:
+        return Completed(validator(value))
+    return pool.apply_async(validator, (value,))
+
+
+_regex_cache = LRUCache(500)
+_code_cache = LRUCache(500)
+
+def compile_regex(pattern, flags=0):
+    """
+    re.compile(pattern, flags), sharing the compiled patterns between the
+    validators: defining many tables with the same patterns compiles each
+    of them once. Unlike the cache of the re module, which is emptied when
+    it gets more than 100 patterns, it drops the least recently used ones.
+    An already compiled pattern is returned as is.
+    """
+    if not isinstance(pattern, basestring):
+        return pattern
+    key = (type(pattern), pattern, flags)
+    regex = _regex_cache.get(key)
+    if regex is None:
+        regex = re.compile(pattern, flags)
+        _regex_cache.set(key, regex)
+    return regex
+
+
+def compile_expression(expression):
+    """ the code object evaluating expression, shared like compile_regex """
+    code = _code_cache.get(expression)
+    if code is None:
+        code = compile(expression, '<IS_EXPR>', 'eval')
+        _code_cache.set(expression, code)
+    return code
+
+
 class IS_MATCH(Validator):
     """
     example::
@@ -124,8 +210,10 @@ class IS_MATCH(Validator):
         ('', 'invalid expression')
     """
 
+    cacheable = True
+
     def __init__(self, expression, error_message='invalid expression'):
-        self.regex = re.compile(expression)
+        self.regex = compile_regex(expression)
         self.error_message = error_message
 
     def __call__(self, value):
@@ -152,6 +240,9 @@ class IS_EQUAL_TO(Validator):
         ('aab', 'no match')
     """
 
+    reorderable = True
+    cacheable = True
+
     def __init__(self, expression, error_message='no match'):
         self.expression = expression
         self.error_message = error_message
@@ -178,14 +269,26 @@ class IS_EXPR(Validator):
         ('2', 'invalid expression')
     """
 
+    reorderable = True
+    cacheable = True
+
     def __init__(self, expression, error_message='invalid expression'):
         self.expression = expression
         self.error_message = error_message
+        self.code = compile_expression(expression)
+
+    def __getstate__(self):
+        # code objects cannot be pickled, the expression is compiled on load
+        state = dict(self.__dict__)
+        del state['code']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.code = compile_expression(self.expression)
 
     def __call__(self, value):
-        environment = {'value': value}
-        exec '__ret__=' + self.expression in environment
-        if environment['__ret__']:
+        if eval(self.code, {'value': value}):
             return (value, None)
         return (value, self.error_message)
 
@@ -221,6 +324,9 @@ class IS_LENGTH(Validator):
         ('1234567890', 'enter from 20 to 50 characters')
     """
 
+    reorderable = True
+    cacheable = True
+
     def __init__(self, maxsize=0, minsize=0, error_message=None):
         self.maxsize = maxsize
         self.minsize = minsize
@@ -235,16 +341,7 @@ class IS_LENGTH(Validator):
 
     def __call__(self, value):
         if isinstance(value, cgi.FieldStorage):
-            if value.file:
-                value.file.seek(0, os.SEEK_END)
-                length = value.file.tell()
-                value.file.seek(0, os.SEEK_SET)
-            else:
-                val = value.value
-                if val:
-                    length = len(val)
-                else:
-                    length = 0
+            length = upload_size(value)
         elif isinstance(value, (str, unicode, list)):
             length = len(value)
         else:
@@ -256,6 +353,8 @@ class IS_LENGTH(Validator):
         return (value, None)
 
 class IS_NOT_IN_SET(Validator):
+    cacheable = True
+
     def __init__(self, theset, error_message='value not allowed'):
         self.theset = theset
         self.error_message = error_message
@@ -295,6 +394,8 @@ class IS_IN_SET(Validator):
         ('id1', None)
     """
 
+    cacheable = True
+
     def __init__(
         self,
         theset,
@@ -306,6 +407,7 @@ class IS_IN_SET(Validator):
         ):
         from html import xmlescape
         self.multiple = multiple
+        self.reorderable = not multiple
         if isinstance(theset, dict):
             self.theset = [xmlescape(item) for item in theset]
             self.labels = theset.values()
@@ -369,6 +471,8 @@ class IS_IN_DB(Validator):
     used for reference fields, rendered as a dropbox
     """
 
+    io_bound = True
+
     def __init__(
         self,
         dbset,
@@ -382,12 +486,14 @@ class IS_IN_DB(Validator):
         zero='',
         sort=False,
         _and=None,
+        pool=None,
         ):
         if hasattr(dbset, 'define_table'):
             self.dbset = dbset()
         else:
             self.dbset = dbset
         self.field = field
+        self.pool = pool
         (ktable, kfield) = str(self.field).split('.')
         if not label:
             label = '%%(%s)s' % kfield
@@ -434,21 +540,28 @@ class IS_IN_DB(Validator):
             orderby = self.orderby or reduce(lambda a,b:a|b,(f for f in fields if not f.name=='id'))
             dd = dict(orderby=orderby, cache=self.cache)
             records = self.dbset.select(self.dbset.db[self.ktable].ALL, **dd)
-        self.theset = [str(r[self.kfield]) for r in records]
+        theset = [str(r[self.kfield]) for r in records]
         if isinstance(self.label,str):
-            self.labels = [self.label % dict(r) for r in records]
+            labels = [self.label % dict(r) for r in records]
         else:
-            self.labels = [self.label(r) for r in records]
+            labels = [self.label(r) for r in records]
+        # the validator may be shared by concurrent requests, options()
+        # uses the returned lists, not the attributes set here
+        (self.theset, self.labels) = (theset, labels)
+        return (theset, labels)
 
     def options(self):
-        self.build_set()
-        items = [(k, self.labels[i]) for (i, k) in enumerate(self.theset)]
+        (theset, labels) = self.build_set()
+        items = [(k, labels[i]) for (i, k) in enumerate(theset)]
         if self.sort:
             items.sort(options_sorter)
         if self.zero != None and not self.multiple:
             items.insert(0,('',self.zero))
         return items
 
+    def __acall__(self, value):
+        return call_async(self, value, self.pool)
+
     def __call__(self, value):
         if self.multiple:
             if isinstance(value,list):
@@ -486,14 +599,23 @@ class IS_NOT_IN_DB(Validator):
         INPUT(_type='text', _name='name', requires=IS_NOT_IN_DB(db, db.table))
 
     makes the field unique
+
+    with a pool (a multiprocessing ThreadPool) the query runs on the pool
+    when the form is validated by accepts_async, concurrently with the
+    checks of the other fields
     """
 
+    io_bound = True
+    # __call__ returns str(value)
+    reorderable = False
+
     def __init__(
         self,
         dbset,
         field,
         error_message='value already in database or empty',
         allowed_override=[],
+        pool=None,
         ):
         if hasattr(dbset, 'define_table'):
             self.dbset = dbset()
@@ -503,10 +625,14 @@ class IS_NOT_IN_DB(Validator):
         self.error_message = error_message
         self.record_id = 0
         self.allowed_override = allowed_override
+        self.pool = pool
 
     def set_self_id(self, id):
         self.record_id = id
 
+    def __acall__(self, value):
+        return call_async(self, value, self.pool)
+
     def __call__(self, value):
         value=str(value)
         if not value.strip():
@@ -526,6 +652,99 @@ class IS_NOT_IN_DB(Validator):
         return (value, None)
 
 
+def parse_int(value):
+    """
+    int(value) for strings ('4.0' is not an integer), for numbers the int
+    equal to value, otherwise ValueError
+    """
+    if isinstance(value, basestring):
+        return int(value)
+    ivalue = int(value)
+    if ivalue != value:
+        raise ValueError, 'not an integer: %r' % value
+    return ivalue
+
+
+def range_mask(numbers, minimum=None, maximum=None, closed=True):
+    """
+    the mask of the numbers between minimum and maximum (included if closed)
+    computed at once: a numpy array of booleans or, without numpy, an
+    array('b') of 0 and 1. NaN is in no range.
+    """
+    try:
+        return _range_mask(numbers, minimum, maximum, closed)
+    except decimal.InvalidOperation:
+        # comparing a Decimal NaN raises, it is compared as 0 and left out
+        nans = [i for (i, n) in enumerate(numbers)
+                if isinstance(n, decimal.Decimal) and n.is_nan()]
+        numbers = list(numbers)
+        for i in nans:
+            numbers[i] = 0
+        mask = _range_mask(numbers, minimum, maximum, closed)
+        for i in nans:
+            mask[i] = False
+        return mask
+
+
+def _range_mask(numbers, minimum, maximum, closed):
+    if numpy is not None:
+        numbers = numpy.array(numbers)
+        mask = numpy.ones(len(numbers), dtype=bool)
+        if minimum is not None:
+            mask &= numbers >= minimum
+        if maximum is not None:
+            if closed:
+                mask &= numbers <= maximum
+            else:
+                mask &= numbers < maximum
+        return mask
+    if minimum is None and maximum is None:
+        return array.array('b', [1]) * len(numbers)
+    elif maximum is None:
+        mask = [n >= minimum for n in numbers]
+    elif minimum is None and closed:
+        mask = [n <= maximum for n in numbers]
+    elif minimum is None:
+        mask = [n < maximum for n in numbers]
+    elif closed:
+        mask = [minimum <= n <= maximum for n in numbers]
+    else:
+        mask = [minimum <= n < maximum for n in numbers]
+    return array.array('b', mask)
+
+
+def validate_column(validator, values, parse, closed=True):
+    """
+    validates all the values with a range validator: parses them with
+    parse, checks their range with range_mask and returns (numbers, mask,
+    errors). numbers and errors (a dict index:error) match what
+    validator(value) returns for every value, mask tells the valid ones.
+    """
+    invalid = []
+    try:
+        numbers = map(parse, values)
+    except (ValueError, TypeError, ArithmeticError):
+        numbers = []
+        for (i, value) in enumerate(values):
+            try:
+                numbers.append(parse(value))
+            except (ValueError, TypeError, ArithmeticError):
+                numbers.append(0)
+                invalid.append(i)
+    mask = range_mask(numbers, validator.minimum, validator.maximum, closed)
+    for i in invalid:
+        mask[i] = False
+    errors = {}
+    for i in [i for (i, valid) in enumerate(mask) if not valid]:
+        # few values are invalid, the validator gives their exact result
+        (numbers[i], error) = validator(values[i])
+        if error is None:
+            mask[i] = True
+        else:
+            errors[i] = error
+    return (numbers, mask, errors)
+
+
 class IS_INT_IN_RANGE(Validator):
     """
     Determine that the argument is (or can be represented as) an int,
@@ -563,8 +782,18 @@ class IS_INT_IN_RANGE(Validator):
         (6, None)
         >>> IS_INT_IN_RANGE()('abc')
         ('abc', 'enter an integer')
+
+    validate_column validates a list of values at once, see the function
+    validate_column::
+
+        >>> (numbers, mask, errors) = IS_INT_IN_RANGE(1,5).validate_column(
+        ...     ['1', '4', '9', 'x'])
+        >>> numbers, [bool(valid) for valid in mask], errors
+        ([1, 4, 9, 'x'], [True, True, False, False], {2: 'enter an integer between 1 and 4', 3: 'enter an integer between 1 and 4'})
     """
 
+    cacheable = True
+
     def __init__(
         self,
         minimum=None,
@@ -594,10 +823,13 @@ class IS_INT_IN_RANGE(Validator):
 
     def __call__(self, value):
         try:
-            fvalue = float(value)
-            value = int(value)
-            if value != fvalue:
-                return (value, self.error_message)
+            if isinstance(value, basestring):
+                value = int(value)
+            else:
+                ivalue = int(value)
+                if ivalue != value:
+                    return (ivalue, self.error_message)
+                value = ivalue
             if self.minimum is None:
                 if self.maximum is None or value < self.maximum:
                     return (value, None)
@@ -610,6 +842,13 @@ class IS_INT_IN_RANGE(Validator):
             pass
         return (value, self.error_message)
 
+    def validate_column(self, values):
+        parse = parse_int
+        if set(map(type, values)) <= set([str, unicode, int, long]):
+            # int() of these is exact, it does not need checking
+            parse = int
+        return validate_column(self, values, parse, closed=False)
+
 
 class IS_FLOAT_IN_RANGE(Validator):
     """
@@ -650,6 +889,8 @@ class IS_FLOAT_IN_RANGE(Validator):
         ('abc', 'enter a number')
     """
 
+    cacheable = True
+
     def __init__(
         self,
         minimum=None,
@@ -696,6 +937,13 @@ class IS_FLOAT_IN_RANGE(Validator):
             pass
         return (value, self.error_message)
 
+    def validate_column(self, values):
+        if self.dot == '.':
+            parse = float
+        else:
+            parse = lambda value: float(str(value).replace(self.dot, '.'))
+        return validate_column(self, values, parse)
+
     def formatter(self,value):
         if self.dot=='.':
             return str(value)
@@ -756,6 +1004,8 @@ class IS_DECIMAL_IN_RANGE(Validator):
         ('abc', 'enter a decimal number')
     """
 
+    cacheable = True
+
     def __init__(
         self,
         minimum=None,
@@ -802,6 +1052,19 @@ class IS_DECIMAL_IN_RANGE(Validator):
             pass
         return (value, self.error_message)
 
+    def validate_column(self, values):
+        """
+        validates all the values at once, see validate_column::
+
+            >>> (numbers, mask, errors) = IS_DECIMAL_IN_RANGE(0, 10
+            ...     ).validate_column(['nan', '3'])
+            >>> numbers, map(bool, mask), errors
+            (['nan', Decimal('3')], [False, True], {0: 'enter a number between 0 and 10'})
+        """
+        dot = self.dot
+        parse = lambda value: decimal.Decimal(str(value).replace(dot, '.'))
+        return validate_column(self, values, parse)
+
     def formatter(self, value):
         return str(value).replace('.',self.dot)
 
@@ -847,10 +1110,13 @@ class IS_NOT_EMPTY(Validator):
         ('abc', None)
     """
 
+    reorderable = True
+    cacheable = True
+
     def __init__(self, error_message='enter a value', empty_regex=None):
         self.error_message = error_message
         if empty_regex is not None:
-            self.empty_regex = re.compile(empty_regex)
+            self.empty_regex = compile_regex(empty_regex)
         else:
             self.empty_regex = None
 
@@ -966,7 +1232,18 @@ class IS_EMAIL(Validator):
         ('Ima Fool@example.com', 'enter a valid email address')
         >>> IS_EMAIL()('localguy@localhost')       # localhost as domain
         ('localguy@localhost', None)
+        >>> IS_EMAIL(banned='^.*\.com(|\..*)$').validate_many(
+        ...     ['a@example.org', 'b@example.com', 'c..d@example.org'])
+        [('a@example.org', None), ('b@example.com', 'enter a valid email address'), ('c..d@example.org', 'enter a valid email address')]
+
+    the address is checked in two steps: the name with a linear pattern, then
+    the domain, whose verdict (including banned and forced) is kept in an
+    LRU cache of the cache_size most recently seen domains, so a list of
+    addresses sharing few domains matches each domain once. validate_many
+    checks a list of addresses and returns a list of (value, error).
 
+    regex is the equivalent pattern of the whole address, setting another
+    regex (in a subclass or on the instance) validates with it instead.
     """
 
     regex = re.compile('''
@@ -993,29 +1270,97 @@ class IS_EMAIL(Validator):
        )$
     ''', re.VERBOSE|re.IGNORECASE)
 
+    regex_domain = re.compile('''
+        (
+          localhost
+          |
+          (
+            [a-z0-9]                         # [sub]domain begins with alphanumeric
+            (
+              [-\w]*                         # alphanumeric, underscore, dot, hyphen
+              [a-z0-9]                       # ending alphanumeric
+            )?
+          \.                               # ending dot
+          )+
+          [a-z]{2,}                        # TLD alpha-only
+       )$
+    ''', re.VERBOSE|re.IGNORECASE)
+
+    # the name: legal characters and single dots, not at the ends
+    name_chars = "-abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ" \
+        "0123456789!#$%&'*+/=?^_`{|}~"
+    regex_name = re.compile(r"[%s]+(\.[%s]+)*\Z" % (
+            re.escape(name_chars), re.escape(name_chars)))
+
     regex_proposed_but_failed = re.compile('^([\w\!\#$\%\&\'\*\+\-\/\=\?\^\`{\|\}\~]+\.)*[\w\!\#$\%\&\'\*\+\-\/\=\?\^\`{\|\}\~]+@((((([a-z0-9]{1}[a-z0-9\-]{0,62}[a-z0-9]{1})|[a-z])\.)+[a-z]{2,6})|(\d{1,3}\.){3}\d{1,3}(\:\d{1,5})?)$',re.VERBOSE|re.IGNORECASE)
 
+    reorderable = True
+    cacheable = True
+
     def __init__(self,
                  banned=None,
                  forced=None,
-                 error_message='enter a valid email address'):
+                 error_message='enter a valid email address',
+                 cache_size=1000):
         if isinstance(banned, str):
-            banned = re.compile(banned)
+            banned = compile_regex(banned)
         if isinstance(forced, str):
-            forced = re.compile(forced)
+            forced = compile_regex(forced)
         self.banned = banned
         self.forced = forced
         self.error_message = error_message
+        self.domains = LRUCache(cache_size)
+
+    def valid_domain(self, domain):
+        verdict = self.domains.get(domain)
+        if verdict is None:
+            verdict = bool(self.regex_domain.match(domain)) \
+                and (not self.banned or not self.banned.match(domain)) \
+                and bool(not self.forced or self.forced.match(domain))
+            self.domains.set(domain, verdict)
+        return verdict
 
     def __call__(self, value):
-        match = self.regex.match(value)
-        if match:
-            domain = value.split('@')[1]
-            if (not self.banned or not self.banned.match(domain)) \
-                    and (not self.forced or self.forced.match(domain)):
-                return (value, None)
+        if self.regex is not IS_EMAIL.regex:
+            if self.regex.match(value):
+                domain = value.split('@')[1]
+                if (not self.banned or not self.banned.match(domain)) \
+                        and (not self.forced or self.forced.match(domain)):
+                    return (value, None)
+            return (value, self.error_message)
+        try:
+            (name, domain) = value.split('@')
+        except (ValueError, AttributeError):
+            return (value, self.error_message)
+        if self.regex_name.match(name) and self.valid_domain(domain):
+            return (value, None)
         return (value, self.error_message)
 
+    def validate_many(self, values):
+        """ [self(value) for value in values], faster """
+        if self.regex is not IS_EMAIL.regex:
+            return [self(value) for value in values]
+        (error, valid_name, valid_domain) = \
+            (self.error_message, self.regex_name.match, self.valid_domain)
+        # the verdicts of this batch, looked up without the lock of the LRU
+        domains = {}
+        results = []
+        append = results.append
+        for value in values:
+            try:
+                (name, domain) = value.split('@')
+            except (ValueError, AttributeError):
+                append((value, error))
+                continue
+            verdict = domains.get(domain)
+            if verdict is None:
+                verdict = domains[domain] = valid_domain(domain)
+            if verdict and valid_name(name):
+                append((value, None))
+            else:
+                append((value, error))
+        return results
+
 
 # URL scheme source:
 # <http://en.wikipedia.org/wiki/URI_scheme> obtained on 2008-Nov-10
@@ -1158,6 +1503,15 @@ http_schemes = [None, 'http', 'https']
 url_split_regex = \
     re.compile('^(([^:/?#]+):)?(//([^/?#]*))?([^?#]*)(\?([^#]*))?(#(.*))?')
 
+# used by IS_GENERIC_URL and IS_HTTP_URL on every value
+url_bad_escape_regex = re.compile(
+    r"%[^0-9A-Fa-f]{2}|%[^0-9A-Fa-f][0-9A-Fa-f]|%[0-9A-Fa-f][^0-9A-Fa-f]|%$|%[0-9A-Fa-f]$|%[^0-9A-Fa-f]$")
+url_chars_regex = re.compile(r"[A-Za-z0-9;/?:@&=+$,\-_\.!~*'\(\)%#]+$")
+url_ip_authority_regex = re.compile(
+    "([\w.!~*'|;:&=+$,-]+@)?\d+\.\d+\.\d+\.\d+(:\d*)*$")
+url_domain_authority_regex = re.compile(
+    "([\w.!~*'|;:&=+$,-]+@)?(([A-Za-z0-9]+[A-Za-z0-9\-]*[A-Za-z0-9]+\.)*([A-Za-z0-9]+\.)*)*([A-Za-z]+[A-Za-z0-9\-]*[A-Za-z0-9]+)\.?(:\d*)*$")
+
 # Defined in RFC 3490, Section 3.1, Requirement #1
 # Use this regex to split the authority component of a unicode URL into
 # its component labels
@@ -1329,6 +1683,8 @@ class IS_GENERIC_URL(Validator):
 
     """
 
+    cacheable = True
+
     def __init__(
         self,
         error_message='enter a valid URL',
@@ -1364,12 +1720,9 @@ class IS_GENERIC_URL(Validator):
         """
         try:
             # if the URL does not misuse the '%' character
-            if not re.compile(
-                r"%[^0-9A-Fa-f]{2}|%[^0-9A-Fa-f][0-9A-Fa-f]|%[0-9A-Fa-f][^0-9A-Fa-f]|%$|%[0-9A-Fa-f]$|%[^0-9A-Fa-f]$"
-                              ).search(value):
+            if not url_bad_escape_regex.search(value):
                 # if the URL is only composed of valid characters
-                if re.compile(
-                    r"[A-Za-z0-9;/?:@&=+$,\-_\.!~*'\(\)%#]+$").match(value):
+                if url_chars_regex.match(value):
                     # Then split up the URL into its components and check on
                     # the scheme
                     scheme = url_split_regex.match(value).group(2)
@@ -1385,7 +1738,7 @@ class IS_GENERIC_URL(Validator):
                         # ports, check to see if adding a valid scheme fixes
                         # the problem (but only do this if it doesn't have
                         # one already!)
-                        if not re.compile('://').search(value) and None\
+                        if not '://' in value and None\
                              in self.allowed_schemes:
                             schemeToUse = self.prepend_scheme or 'http'
                             prependTest = self.__call__(schemeToUse
@@ -1744,6 +2097,8 @@ class IS_HTTP_URL(Validator):
 
     """
 
+    cacheable = True
+
     def __init__(
         self,
         error_message='enter a valid URL',
@@ -1796,16 +2151,13 @@ class IS_HTTP_URL(Validator):
                 # if there is an authority component
                 if authority:
                     # if authority is a valid IP address
-                    if re.compile(
-                        "([\w.!~*'|;:&=+$,-]+@)?\d+\.\d+\.\d+\.\d+(:\d*)*$").match(authority):
+                    if url_ip_authority_regex.match(authority):
                         # Then this HTTP URL is valid
                         return (value, None)
                     else:
                         # else if authority is a valid domain name
                         domainMatch = \
-                            re.compile(
-                                "([\w.!~*'|;:&=+$,-]+@)?(([A-Za-z0-9]+[A-Za-z0-9\-]*[A-Za-z0-9]+\.)*([A-Za-z0-9]+\.)*)*([A-Za-z]+[A-Za-z0-9\-]*[A-Za-z0-9]+)\.?(:\d*)*$"
-                                ).match(authority)
+                            url_domain_authority_regex.match(authority)
                         if domainMatch:
                             # if the top-level domain really exists
                             if domainMatch.group(5).lower()\
@@ -1818,13 +2170,13 @@ class IS_HTTP_URL(Validator):
                     path = componentsMatch.group(5)
                     # relative case: if this is a valid path (if it starts with
                     # a slash)
-                    if re.compile('/').match(path):
+                    if path.startswith('/'):
                         # Then this HTTP URL is valid
                         return (value, None)
                     else:
                         # abbreviated case: if we haven't already, prepend a
                         # scheme and see if it fixes the problem
-                        if not re.compile('://').search(value):
+                        if not '://' in value:
                             schemeToUse = self.prepend_scheme or 'http'
                             prependTest = self.__call__(schemeToUse
                                      + '://' + value)
@@ -1918,6 +2270,8 @@ class IS_URL(Validator):
     @author: Jonathan Benn
     """
 
+    cacheable = True
+
     def __init__(
         self,
         error_message='enter a valid URL',
@@ -2037,6 +2391,8 @@ class IS_TIME(Validator):
         ('', 'enter time as hh:mm:ss (seconds, am, pm optional)')
     """
 
+    cacheable = True
+
     def __init__(self, error_message='enter time as hh:mm:ss (seconds, am, pm optional)'):
         self.error_message = error_message
 
@@ -2075,6 +2431,8 @@ class IS_DATE(Validator):
     date has to be in the ISO8960 format YYYY-MM-DD
     """
 
+    cacheable = True
+
     def __init__(self, format='%Y-%m-%d',
                  error_message='enter date as %(format)s'):
         self.format = str(format)
@@ -2112,6 +2470,8 @@ class IS_DATETIME(Validator):
     datetime has to be in the ISO8960 format YYYY-MM-DD hh:mm:ss
     """
 
+    cacheable = True
+
     isodatetime = '%Y-%m-%d %H:%M:%S'
 
     @staticmethod
@@ -2288,22 +2648,95 @@ class IS_DATETIME_IN_RANGE(IS_DATETIME):
         return (value, None)
 
 
-class IS_LIST_OF(Validator):
+class ItemErrors(str):
+    """
+    the error of IS_LIST_OF(all_errors=True): the message of every invalid
+    item, with errors, the list of their (index, error)
+    """
+
+    def __new__(cls, errors):
+        message = '; '.join(['item %s: %s' % (i + 1, e) for (i, e) in errors])
+        if isinstance(message, unicode):
+            message = message.encode('utf8')
+        self = str.__new__(cls, message)
+        self.errors = errors
+        return self
 
-    def __init__(self, other):
+    def __getnewargs__(self):
+        return (self.errors,)
+
+
+class IS_LIST_OF(Validator):
+    """
+    validates every item of a list, or of any iterable (for instance a
+    generator reading a bulk upload), with other::
+
+        >>> IS_LIST_OF(IS_INT_IN_RANGE(0, 10))(['1', '2'])
+        ([1, 2], None)
+        >>> IS_LIST_OF(IS_INT_IN_RANGE(0, 10))(iter(['1', 'x', '3']))
+        ([1, 'x'], 'enter an integer between 0 and 9')
+        >>> (value, errors) = IS_LIST_OF(IS_INT_IN_RANGE(0, 10),
+        ...                              all_errors=True)(['1', 'x', '30'])
+        >>> errors.errors
+        [(1, 'enter an integer between 0 and 9'), (2, 'enter an integer between 0 and 9')]
+        >>> print errors
+        item 2: enter an integer between 0 and 9; item 3: enter an integer between 0 and 9
+
+    the first invalid item stops the validation, unless all_errors is True:
+    then the error is an ItemErrors, the message of every invalid item with
+    their indices and errors in its errors attribute. On errors a list or
+    a tuple is returned as it is, an iterator as the list of the items read
+    (the valid ones validated).
+
+    a tuple is validated item by item, like a list, and the result is a
+    list (before, a tuple was a single item). A list whose items other
+    leaves as they are is returned as it is, not copied: the caller gets
+    the same list object, changing one changes the other. iter_validate
+    yields (index, value, error) for every item without keeping them.
+    """
+
+    def __init__(self, other, all_errors=False):
         self.other = other
+        self.all_errors = all_errors
+        self.io_bound = getattr(other, 'io_bound', False)
+
+    def iter_validate(self, values):
+        """ yields (index, value, error) for every item of values """
+        if not isinstance(values, (list, tuple)) and not hasattr(values, 'next'):
+            values = [values]
+        other = self.other
+        for (i, item) in enumerate(values):
+            (v, e) = other(item)
+            yield (i, v, e)
 
     def __call__(self, value):
-        ivalue = value
-        if not isinstance(value, list):
-            ivalue = [ivalue]
-        new_value = []
-        for item in ivalue:
-            (v, e) = self.other(item)
+        if isinstance(value, list):
+            (items, new_value) = (value, None)
+        elif isinstance(value, tuple) or hasattr(value, 'next'):
+            (items, new_value) = (value, [])
+        else:
+            (items, new_value) = ([value], None)
+        (other, all_errors) = (self.other, self.all_errors)
+        errors = []
+        for (i, item) in enumerate(items):
+            (v, e) = other(item)
             if e:
-                return (value, e)
-            else:
+                errors.append((i, e))
+                v = item
+            if new_value is not None:
                 new_value.append(v)
+            elif not v is item:
+                # the first changed item, copy the list
+                new_value = items[:i]
+                new_value.append(v)
+            if e and not all_errors:
+                break
+        if errors:
+            if hasattr(value, 'next'):
+                value = new_value
+            return (value, all_errors and ItemErrors(errors) or errors[0][1])
+        if new_value is None:
+            new_value = items
         return (new_value, None)
 
 
@@ -2317,6 +2750,8 @@ class IS_LOWER(Validator):
     ('\\xc3\\xb1', None)
     """
 
+    cacheable = True
+
     def __call__(self, value):
         return (value.decode('utf8').lower().encode('utf8'), None)
 
@@ -2331,10 +2766,17 @@ class IS_UPPER(Validator):
     ('\\xc3\\x91', None)
     """
 
+    cacheable = True
+
     def __call__(self, value):
         return (value.decode('utf8').upper().encode('utf8'), None)
 
 
+slug_entity_regex = re.compile('&\w+?;')
+slug_unwanted_regex = re.compile('[^a-z0-9\-\s]')
+slug_hyphens_regex = re.compile('--+')
+
+
 class IS_SLUG(Validator):
     """
     convert arbitrary text string to a slug
@@ -2361,6 +2803,8 @@ class IS_SLUG(Validator):
     ('abc1', None)
     """
 
+    cacheable = True
+
     def __init__(self, maxlen=80, check=False, error_message='must be slug'):
         self.maxlen = maxlen
         self.check = check
@@ -2371,10 +2815,10 @@ class IS_SLUG(Validator):
         s = value.decode('utf-8').lower()    # to lowercase utf-8
         s = unicodedata.normalize('NFKD', s) # normalize eg è => e, ñ => n
         s = s.encode('ASCII', 'ignore')      # encode as ASCII
-        s = re.sub('&\w+?;', '', s)          # strip html entities
-        s = re.sub('[^a-z0-9\-\s]', '', s)   # strip all but alphanumeric/hyphen/space
+        s = slug_entity_regex.sub('', s)     # strip html entities
+        s = slug_unwanted_regex.sub('', s)   # strip all but alphanumeric/hyphen/space
         s = s.replace(' ', '-')              # spaces to hyphens
-        s = re.sub('--+', '-', s)            # collapse strings of hyphens
+        s = slug_hyphens_regex.sub('-', s)   # collapse strings of hyphens
         s = s.strip('-')                     # remove leading and traling hyphens
         return s[:maxlen].strip('-')         # enforce maximum length
 
@@ -2404,13 +2848,26 @@ class IS_EMPTY_OR(Validator):
     def __init__(self, other, null=None, empty_regex=None):
         (self.other, self.null) = (other, null)
         if empty_regex is not None:
-            self.empty_regex = re.compile(empty_regex)
+            self.empty_regex = compile_regex(empty_regex)
         else:
             self.empty_regex = None
         if hasattr(other, 'multiple'):
             self.multiple = other.multiple
         if hasattr(other, 'options'):
             self.options=self._options
+        self.io_bound = getattr(other, 'io_bound', False)
+        self.cacheable = getattr(other, 'cacheable', False)
+
+    def __getstate__(self):
+        # bound methods cannot be pickled, options is restored on load
+        state = dict(self.__dict__)
+        state.pop('options', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if hasattr(self.other, 'options'):
+            self.options=self._options
 
     def _options(self):
         options = self.other.options()
@@ -2437,6 +2894,188 @@ class IS_EMPTY_OR(Validator):
 IS_NULL_OR = IS_EMPTY_OR    # for backward compatibility
 
 
+class ADAPTIVE(Validator):
+    """
+    example::
+
+        INPUT(_type='text', _name='email',
+              requires=ADAPTIVE(IS_NOT_EMPTY(), IS_EMAIL(), IS_LENGTH(255),
+                                IS_NOT_IN_DB(db, 'person.email')))
+
+    runs the validators like a list of validators (requires=[...]), stopping
+    at the first error, but measures how long each one takes and how often
+    it rejects the value, and reorders them so the cheap validators that
+    often fail run first: bad values stop costing the expensive checks.
+
+    Only the reorderable validators (see Validator.reorderable, they do not
+    change the value) are moved, and only between the validators that do
+    change the value (IS_LOWER, IS_SLUG, CLEANUP, IS_INT_IN_RANGE...),
+    which keep their place. When a value fails several validators the
+    error is the one of the validator that runs first.
+
+    The validators are ranked by cost / rejection rate, the order minimizing
+    the expected cost, after warmup values and then every interval values.
+    The statistics are shared by the threads validating with the same
+    ADAPTIVE, each call updates them once under a lock.
+    Validators with options (IS_IN_SET, IS_IN_DB as a dropbox) should stay
+    outside, the widgets do not see their options through ADAPTIVE.
+    """
+
+    def __init__(self, *validators, **kwargs):
+        if len(validators) == 1 and isinstance(validators[0], (list, tuple)):
+            validators = validators[0]
+        self.validators = list(validators)
+        self.warmup = kwargs.get('warmup', 100)
+        self.interval = kwargs.get('interval', 1000)
+        self.io_bound = bool([v for v in self.validators
+                              if getattr(v, 'io_bound', False)])
+        n = len(self.validators)
+        self.calls = [0] * n
+        self.costs = [0.0] * n
+        self.rejections = [0] * n
+        self.count = 0
+        self.order = tuple(range(n))
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def segments(self):
+        """
+        the indexes of the validators grouped in segments that can be
+        reordered, a validator that is not reorderable is a segment alone
+        """
+        (segments, current) = ([], [])
+        for (i, validator) in enumerate(self.validators):
+            if getattr(validator, 'reorderable', False):
+                current.append(i)
+            else:
+                if current:
+                    segments.append(current)
+                segments.append([i])
+                current = []
+        if current:
+            segments.append(current)
+        return segments
+
+    def rank(self):
+        """ recomputes the order of the validators from the statistics """
+        def key(i):
+            calls = self.calls[i]
+            if not calls:
+                return 0.0
+            cost = self.costs[i] / calls
+            rate = float(self.rejections[i]) / calls
+            return cost / max(rate, 1e-6)
+        order = []
+        for segment in self.segments():
+            order.extend(sorted(segment, key=key))
+        self.order = tuple(order)
+        return self.order
+
+    def __call__(self, value):
+        validators = self.validators
+        (timings, error, rejected) = ([], None, None)
+        for i in self.order:
+            t0 = time.time()
+            (value, error) = validators[i](value)
+            timings.append((i, time.time() - t0))
+            if error is not None:
+                rejected = i
+                break
+        (calls, costs) = (self.calls, self.costs)
+        self.lock.acquire()
+        try:
+            for (i, seconds) in timings:
+                costs[i] += seconds
+                calls[i] += 1
+            if rejected is not None:
+                self.rejections[rejected] += 1
+            self.count += 1
+            if self.count >= self.warmup and \
+                    (self.count - self.warmup) % self.interval == 0:
+                self.rank()
+        finally:
+            self.lock.release()
+        return (value, error)
+
+
+class MEMOIZE(Validator):
+    """
+    example::
+
+        INPUT(_type='text', _name='website', requires=MEMOIZE(IS_URL()))
+
+    caches the results of a cacheable validator (see Validator.cacheable),
+    so the values submitted again and again (domains, dates, countries) are
+    validated once. The cache keeps the last maxsize values and counts its
+    hits and misses (MEMOIZE(...).cache.stats()).
+
+    Only the str, unicode, numbers, booleans and None values are cached,
+    the others (lists, uploads...) are always validated, and so are the
+    values whose result is not immutable.
+
+    options() and multiple are the ones of the validator, so a memoized
+    IS_IN_SET keeps its dropbox::
+
+        >>> memoized = MEMOIZE(IS_IN_SET(['a', 'b'], multiple=True))
+        >>> memoized.options(), memoized.multiple, memoized(['a'])
+        ([('a', 'a'), ('b', 'b')], True, (['a'], None))
+    """
+
+    def __init__(self, other, maxsize=1000):
+        if not getattr(other, 'cacheable', False):
+            raise SyntaxError, '%s is not cacheable' % \
+                other.__class__.__name__
+        self.other = other
+        self.cache = LRUCache(maxsize)
+        self.cacheable = True
+        self.reorderable = getattr(other, 'reorderable', False)
+        self.io_bound = getattr(other, 'io_bound', False)
+        if hasattr(other, 'multiple'):
+            self.multiple = other.multiple
+        if hasattr(other, 'options'):
+            self.options = self._options
+
+    def __getstate__(self):
+        # bound methods cannot be pickled, options is restored on load
+        state = dict(self.__dict__)
+        state.pop('options', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if hasattr(self.other, 'options'):
+            self.options = self._options
+
+    def _options(self):
+        return self.other.options()
+
+    def __call__(self, value):
+        if not type(value) in _immutable:
+            return self.other(value)
+        key = (type(value), value)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.other(value)
+            if type(result[0]) in _immutable:
+                self.cache.set(key, result)
+        return result
+
+    def formatter(self, value):
+        return self.other.formatter(value)
+
+_immutable = (str, unicode, int, long, float, bool, type(None),
+              datetime.date, datetime.datetime, datetime.time,
+              decimal.Decimal)
+
+
 class CLEANUP(Validator):
     """
     example::
@@ -2446,14 +3085,30 @@ class CLEANUP(Validator):
     removes special characters on validation
     """
 
+    cacheable = True
+
     def __init__(self, regex='[^ \n\w]'):
-        self.regex = re.compile(regex)
+        self.regex = compile_regex(regex)
 
     def __call__(self, value):
         v = self.regex.sub('',str(value).strip())
         return (v, None)
 
 
+regex_pbkdf2 = re.compile(r'^pbkdf2\((\d+),(\d+),(\w+)\)$')
+
+
+def _pbkdf2_unless_cancelled(cancelled, args):
+    """
+    pbkdf2_hex(*args) for CRYPT, unless the caller stopped waiting for it
+    (cancelled is not empty) before a worker took it. In a process pool
+    cancelled is a copy and never changes.
+    """
+    if cancelled:
+        return None
+    return pbkdf2_hex(*args)
+
+
 class CRYPT(object):
     """
     example::
@@ -2467,9 +3122,25 @@ class CRYPT(object):
     If the digest_alg is specified this is used to replace the
     MD5 with, for example, SHA512. The digest_alg can be
     the name of a hashlib algorithm as a string or the algorithm itself.
+
+    For passwords use key stretching, digest_alg='pbkdf2(iterations,keylen,alg)'
+    like 'pbkdf2(1000,20,sha512)'. Every value gets a new random salt, the
+    result describes itself as 'pbkdf2(1000,20,sha512)$salt$hash', and is
+    checked with verify::
+
+        crypt = CRYPT(digest_alg='pbkdf2(1000,20,sha512)', pool=4, timeout=5)
+        crypt.verify(request.vars.password, user.password)
+
+    The derivation can run on a pool: pool is an object with apply_async
+    (a multiprocessing Pool or ThreadPool) or the number of threads of a
+    pool owned by the validator, stopped by close(). If it does not finish
+    within timeout seconds the value is rejected with error_message; a
+    derivation still waiting in a thread pool is then skipped, one already
+    running finishes in the background.
     """
 
-    def __init__(self, key=None, digest_alg=None):
+    def __init__(self, key=None, digest_alg=None, pool=None, timeout=None,
+                 error_message='password hashing timed out, try again'):
         if key and not digest_alg:
             if key.count(':')==1:
                 (digest_alg, key) = key.split(':')
@@ -2477,13 +3148,194 @@ class CRYPT(object):
             digest_alg = 'md5' # for backward compatibility
         self.key = key
         self.digest_alg = digest_alg
+        self.pool = pool
+        self.timeout = timeout
+        self.error_message = error_message
+        self.stretching = None
+        if isinstance(digest_alg, str):
+            match = regex_pbkdf2.match(digest_alg)
+            if match:
+                if key:
+                    raise SyntaxError, 'CRYPT with pbkdf2 does not use a key'
+                (iterations, keylen, alg) = match.groups()
+                get_digest(alg) # checks the algorithm
+                self.stretching = (int(iterations), int(keylen), alg)
+
+    _lock = threading.Lock()
+
+    def _new(self):
+        """
+        returns an empty digest (or hmac) object. The algorithm and the key
+        are resolved once, then the same empty object is copied.
+        """
+        prototype = self.__dict__.get('_prototype')
+        if prototype is None:
+            if self.key:
+                prototype = hmac.new(self.key, '', get_digest(self.digest_alg))
+            elif isinstance(self.digest_alg, str):
+                prototype = new_digest(self.digest_alg)
+            else:
+                prototype = self.digest_alg()
+            self._prototype = prototype
+        return prototype.copy()
+
+    def _get_pool(self):
+        if not isinstance(self.pool, (int, long)):
+            return self.pool
+        self._lock.acquire()
+        try:
+            pool = self.__dict__.get('_pool')
+            if pool is None:
+                from multiprocessing.pool import ThreadPool
+                pool = self._pool = ThreadPool(self.pool)
+            return pool
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """
+        stops the pool created by the validator (when pool is a number of
+        threads), a later derivation starts a new one
+        """
+        self._lock.acquire()
+        try:
+            pool = self.__dict__.pop('_pool', None)
+        finally:
+            self._lock.release()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    def __del__(self):
+        pool = self.__dict__.get('_pool')
+        if pool is not None:
+            try:
+                pool.terminate()
+            except Exception:
+                pass
+
+    def __getstate__(self):
+        # digest objects and pools cannot be pickled, they are built again
+        # when needed
+        state = dict(self.__dict__)
+        state.pop('_prototype', None)
+        state.pop('_pool', None)
+        return state
+
+    def _derive(self, items):
+        """
+        items is a list of (value, salt, stretching), returns the list of
+        the derived hex keys
+        """
+        args = [(value, salt) + stretching for (value, salt, stretching)
+                in items]
+        pool = self._get_pool()
+        if pool is None:
+            return [pbkdf2_hex(*a) for a in args]
+        # set when the caller stops waiting, see _pbkdf2_unless_cancelled
+        cancelled = []
+        results = [pool.apply_async(_pbkdf2_unless_cancelled, (cancelled, a))
+                   for a in args]
+        if self.timeout is None:
+            return [result.get() for result in results]
+        import multiprocessing
+        deadline = time.time() + self.timeout
+        try:
+            return [result.get(max(0, deadline - time.time()))
+                    for result in results]
+        except multiprocessing.TimeoutError:
+            cancelled.append(True)
+            raise
+
+    def _stretch(self, values):
+        import multiprocessing
+        salts = [os.urandom(8).encode('hex') for value in values]
+        try:
+            keys = self._derive([(value, salt, self.stretching)
+                                 for (value, salt) in zip(values, salts)])
+        except multiprocessing.TimeoutError:
+            return None
+        prefix = 'pbkdf2(%s,%s,%s)' % self.stretching
+        return ['%s$%s$%s' % (prefix, salt, key)
+                for (salt, key) in zip(salts, keys)]
 
     def __call__(self, value):
-        if self.key:
-            alg = get_digest(self.digest_alg)
-            return (hmac.new(self.key, value, alg).hexdigest(), None)
-        else:
-            return (hash(value, self.digest_alg), None)
+        """
+        value can be a string, an upload (a file or a cgi.FieldStorage)
+        or an iterable of string chunks, see hashfunc.update_digest.
+        With pbkdf2 the value must be a string.
+        """
+        if self.stretching:
+            hashed = self._stretch([value])
+            if hashed is None:
+                return (value, self.error_message)
+            return (hashed[0], None)
+        return (update_digest(self._new(), value).hexdigest(), None)
+
+    def hash_many(self, values):
+        """
+        returns the list of the hex digests of values, in one call::
+
+            >>> CRYPT().hash_many(['a', 'b'])
+            ['0cc175b9c0f1b6a831c399e269772661', '92eb5ffee6ae2fec3ad71c777531578f']
+
+        with pbkdf2 the values are derived in parallel when there is a pool,
+        and a timeout raises multiprocessing.TimeoutError.
+        """
+        if self.stretching:
+            hashed = self._stretch(list(values))
+            if hashed is None:
+                import multiprocessing
+                raise multiprocessing.TimeoutError
+            return hashed
+        new = self._new
+        return [update_digest(new(), value).hexdigest() for value in values]
+
+    def verify(self, value, stored):
+        """
+        True if stored is the hash of value. A pbkdf2 hash is checked with
+        its own parameters, so the hashes stored before the iterations were
+        raised still verify. stored can be unicode, as read from a database::
+
+            >>> crypt = CRYPT(digest_alg='pbkdf2(10,20,sha512)')
+            >>> stored = unicode(crypt('secret')[0])
+            >>> crypt.verify('secret', stored), crypt.verify(u'secret', stored)
+            (True, True)
+            >>> crypt.verify('wrong', stored), crypt.verify('secret', u'\xe9$a$b')
+            (False, False)
+            >>> CRYPT().verify('a', u'0cc175b9c0f1b6a831c399e269772661')
+            True
+        """
+        if not isinstance(stored, basestring):
+            return False
+        if isinstance(stored, unicode):
+            try:
+                stored = stored.encode('ascii')
+            except UnicodeError:
+                # a hash is hexadecimal
+                return False
+        if '$' in stored:
+            (alg, salt, key) = stored.split('$', 2)
+            match = regex_pbkdf2.match(alg)
+            if not match:
+                return False
+            (iterations, keylen, alg) = match.groups()
+            import multiprocessing
+            try:
+                (derived,) = self._derive(
+                    [(value, salt, (int(iterations), int(keylen), alg))])
+            except multiprocessing.TimeoutError:
+                return False
+            return compare(derived, key)
+        if self.stretching:
+            return False
+        return compare(update_digest(self._new(), value).hexdigest(), stored)
+
+
+upper_regex = re.compile('[A-Z]')
+lower_regex = re.compile('[a-z]')
+number_regex = re.compile('[0-9]')
+word_regex = re.compile('\w+')
 
 
 class IS_STRONG(object):
@@ -2496,6 +3348,8 @@ class IS_STRONG(object):
     enforces complexity requirements on a field
     """
 
+    reorderable = True
+
     def __init__(self, min=8, max=20, upper=1, lower=1, number=1,
                  special=1, specials=r'~!@#$%^&*()_+-=?<>,.:;{}[]|',
                  invalid=' "', error_message=None):
@@ -2528,7 +3382,7 @@ class IS_STRONG(object):
                 failures.append("May not contain any of the following: %s" \
                     % self.invalid)
         if type(self.upper) == int:
-            all_upper = re.findall("[A-Z]", value)
+            all_upper = upper_regex.findall(value)
             if self.upper > 0:
                 if not len(all_upper) >= self.upper:
                     failures.append("Must include at least %s upper case" \
@@ -2537,7 +3391,7 @@ class IS_STRONG(object):
                 if len(all_upper) > 0:
                     failures.append("May not include any upper case letters")
         if type(self.lower) == int:
-            all_lower = re.findall("[a-z]", value)
+            all_lower = lower_regex.findall(value)
             if self.lower > 0:
                 if not len(all_lower) >= self.lower:
                     failures.append("Must include at least %s lower case" \
@@ -2546,7 +3400,7 @@ class IS_STRONG(object):
                 if len(all_lower) > 0:
                     failures.append("May not include any lower case letters")
         if type(self.number) == int:
-            all_number = re.findall("[0-9]", value)
+            all_number = number_regex.findall(value)
             if self.number > 0:
                 numbers = "number"
                 if self.number > 1:
@@ -2566,6 +3420,9 @@ class IS_STRONG(object):
             return (value, self.error_message)
 
 class IS_GREATER_THAN(Validator):
+    reorderable = True
+    cacheable = True
+
     def __init__(self, minvalue, error_message="too small"):
         self.error_message = error_message
         self.minvalue = minvalue
@@ -2576,6 +3433,9 @@ class IS_GREATER_THAN(Validator):
         return (value, None)
 
 class IS_LESS_THAN(Validator):
+    reorderable = True
+    cacheable = True
+
     def __init__(self, maxvalue, error_message="too big"):
         self.error_message = error_message
         self.maxvalue = maxvalue
@@ -2591,7 +3451,7 @@ class IS_IN_SUBSET(IS_IN_SET):
         IS_IN_SET.__init__(self, *a, **b)
 
     def __call__(self, value):
-        values = re.compile("\w+").findall(str(value))
+        values = word_regex.findall(str(value))
         failures = [x for x in values if IS_IN_SET.__call__(self, x)[1]]
         if failures:
             return (value, self.error_message)
@@ -2620,6 +3480,9 @@ class IS_IMAGE(Validator):
 
     Use (-1, -1) as minsize to pass image size check.
 
+    The headers are read from the mapped file (see uploads.mapped), the
+    image is never read into memory.
+
     Examples::
 
         #Check if uploaded file is in any of supported image formats:
@@ -2634,6 +3497,9 @@ class IS_IMAGE(Validator):
             requires=IS_IMAGE(extensions=('png'), maxsize=(200, 200)))
     """
 
+    io_bound = True
+    reorderable = True
+
     def __init__(self,
                  extensions=('bmp', 'gif', 'jpeg', 'png'),
                  maxsize=(10000, 10000),
@@ -2653,17 +3519,22 @@ class IS_IMAGE(Validator):
             if extension == 'jpg':
                 extension = 'jpeg'
             assert extension in self.extensions
-            if extension == 'bmp':
-                width, height = self.__bmp(value.file)
-            elif extension == 'gif':
-                width, height = self.__gif(value.file)
-            elif extension == 'jpeg':
-                width, height = self.__jpeg(value.file)
-            elif extension == 'png':
-                width, height = self.__png(value.file)
-            else:
-                width = -1
-                height = -1
+            view = mapped(value.file)
+            try:
+                data = view.open()
+                if extension == 'bmp':
+                    width, height = self.__bmp(data)
+                elif extension == 'gif':
+                    width, height = self.__gif(data)
+                elif extension == 'jpeg':
+                    width, height = self.__jpeg(data)
+                elif extension == 'png':
+                    width, height = self.__png(data)
+                else:
+                    width = -1
+                    height = -1
+            finally:
+                view.close()
             assert self.minsize[0] <= width <= self.maxsize[0] \
                 and self.minsize[1] <= height <= self.maxsize[1]
             value.file.seek(0)
@@ -2671,37 +3542,37 @@ class IS_IMAGE(Validator):
         except:
             return (value, self.error_message)
 
-    def __bmp(self, stream):
-        if stream.read(2) == 'BM':
-            stream.read(16)
-            return struct.unpack("<LL", stream.read(8))
+    def __bmp(self, data):
+        if data[:2] == 'BM':
+            return struct.unpack("<LL", data[18:26])
         return (-1, -1)
 
-    def __gif(self, stream):
-        if stream.read(6) in ('GIF87a', 'GIF89a'):
-            stream = stream.read(5)
-            if len(stream) == 5:
-                return tuple(struct.unpack("<HHB", stream)[:-1])
+    def __gif(self, data):
+        if data[:6] in ('GIF87a', 'GIF89a'):
+            data = data[6:11]
+            if len(data) == 5:
+                return tuple(struct.unpack("<HHB", data)[:-1])
         return (-1, -1)
 
-    def __jpeg(self, stream):
-        if stream.read(2) == '\xFF\xD8':
+    def __jpeg(self, data):
+        if data[:2] == '\xFF\xD8':
+            # the segments: marker, code, length including the length
+            i = 2
             while True:
-                (marker, code, length) = struct.unpack("!BBH", stream.read(4))
+                (marker, code, length) = struct.unpack("!BBH", data[i:i + 4])
                 if marker != 0xFF:
                     break
                 elif code >= 0xC0 and code <= 0xC3:
                     return tuple(reversed(
-                        struct.unpack("!xHH", stream.read(5))))
+                        struct.unpack("!xHH", data[i + 4:i + 9])))
                 else:
-                    stream.read(length - 2)
+                    i += length + 2
         return (-1, -1)
 
-    def __png(self, stream):
-        if stream.read(8) == '\211PNG\r\n\032\n':
-            stream.read(4)
-            if stream.read(4) == "IHDR":
-                return struct.unpack("!LL", stream.read(8))
+    def __png(self, data):
+        if data[:8] == '\211PNG\r\n\032\n':
+            if data[12:16] == "IHDR":
+                return struct.unpack("!LL", data[16:24])
         return (-1, -1)
 
 
@@ -2744,12 +3615,14 @@ class IS_UPLOAD_FILENAME(Validator):
                 extension='^$', case=0))
     """
 
+    reorderable = True
+
     def __init__(self, filename=None, extension=None, lastdot=True, case=1,
             error_message='enter valid filename'):
         if isinstance(filename, str):
-            filename = re.compile(filename)
+            filename = compile_regex(filename)
         if isinstance(extension, str):
-            extension = re.compile(extension)
+            extension = compile_regex(extension)
         self.filename = filename
         self.extension = extension
         self.lastdot = lastdot
@@ -2880,6 +3753,9 @@ class IS_IPV4(Validator):
     private = ((2886729728L, 2886795263L), (3232235520L, 3232301055L))
     automatic = (2851995648L, 2852061183L)
 
+    reorderable = True
+    cacheable = True
+
     def __init__(
         self,
         minip='0.0.0.0',